@@ -18,6 +18,7 @@ import contextlib
 import datetime
 import os
 import shutil
+import socket
 import sys
 import warnings
 import yaml
@@ -73,19 +74,24 @@ def warning_handler(message, category, filename, lineno, file=None, line=None):
     return 'WARNING: %s\n' % (message)
 
 
+def load_settings():
+    settings_file = './ybd.def'
+    if not os.path.exists(settings_file):
+        settings_file = os.path.join(os.path.dirname(__file__), 'ybd.def')
+    with open(settings_file) as f:
+        text = f.read()
+    for key, value in yaml.safe_load(text).items():
+        settings[key] = value
+    settings['pid'] = os.getpid()
+    settings['instance'] = '%s:%s' % (socket.gethostname(), os.getpid())
+
+
 @contextlib.contextmanager
 def setup(target, arch):
     warnings.formatwarning = warning_handler
 
     try:
-        settings_file = './ybd.def'
-        if not os.path.exists(settings_file):
-            settings_file = os.path.join(os.path.dirname(__file__), 'ybd.def')
-        with open(settings_file) as f:
-            text = f.read()
-        for key, value in yaml.safe_load(text).items():
-            settings[key] = value
-        settings['pid'] = os.getpid()
+        load_settings()
         with open(os.devnull, "w") as fnull:
             if call(['git', 'describe', '--all'], stdout=fnull, stderr=fnull):
                 exit(target, 'ERROR: not a git repo', os.getcwd())
@@ -133,8 +139,10 @@ def chdir(dirname=None):
 def timer(this, start_message=''):
     starttime = datetime.datetime.now()
     log(this, start_message)
-    if type(this) is dict:
+    try:
         this['start-time'] = starttime
+    except TypeError:
+        pass
     try:
         yield
     finally:
@@ -16,6 +16,7 @@
 
 import os
 import random
+import time
 from subprocess import call, check_output
 
 import json
@@ -24,6 +25,7 @@ import buildsystem
 import cache
 import repos
 import sandbox
+import scheduler
 from shutil import copyfile
 import utils
 
@@ -31,7 +33,7 @@ import utils
 def deploy(defs, target):
     '''Deploy a cluster definition.'''
 
-    deployment = target if type(target) is dict else defs.get(target)
+    deployment = defs.get(target)
 
     with app.timer(deployment, 'Starting deployment'):
         for system in deployment.get('systems', []):
@@ -57,9 +59,7 @@ def deploy_system(defs, system_spec, parent_location=''):
 
     sandbox.setup(system)
     app.log(system, 'Extracting system artifact into', system['sandbox'])
-    with open(cache.get_cache(defs, system), 'r') as artifact:
-        call(['tar', 'x', '--directory', system['sandbox']],
-              stdin=artifact)
+    cache.extract(system, cache.get_cache(defs, system), system['sandbox'])
 
     for subsystem_spec in system_spec.get('subsystems', []):
         if deploy_defaults:
@@ -101,6 +101,29 @@ def assemble(defs, target):
         app.log(target, 'Skipping assembly for', component.get('arch'))
         return None
 
+    _assemble(defs, component)
+    return cache.cache_key(defs, component)
+
+
+def _claim(defs, component):
+    '''Claim the build of component, waiting if another instance has it.
+
+    Returns False, with the claim released again, if the artifact has
+    appeared in the meantime.
+
+    '''
+    if not cache.claim(defs, component):
+        app.log(component, 'Waiting for another instance to build',
+                cache.cache_key(defs, component))
+        while not cache.claim(defs, component):
+            time.sleep(10)
+    if cache.get_cache(defs, component):
+        cache.release(defs, component)
+        return False
+    return True
+
+
+def _assemble(defs, component):
     def assemble_system_recursively(system):
         assemble(defs, system['path'])
         for subsystem in system.get('subsystems', []):
@@ -126,14 +149,28 @@ def assemble(defs, target):
                 assemble(defs, subcomponent)
                 sandbox.install(defs, component, subcomponent)
 
-        if 'systems' not in component:
-            build(defs, component)
-        do_manifest(component)
-        cache.cache(defs, component,
-                    full_root=component.get('kind') == "system")
-        sandbox.remove(component)
+        # cull here rather than on every unpack, which scanned artifacts
+        # once per install. The trees installed above are locked, so stay
+        if app.settings.get('unpacked-cache-gb'):
+            cache.cull_unpacked()
 
-    return cache.cache_key(defs, component)
+        # claim it only now, so that we don't hold the claim while we
+        # wait for dependencies, and other instances can build them
+        if not _claim(defs, component):
+            app.log(component, 'Built by another instance')
+            sandbox.remove(component)
+            return
+
+        try:
+            sandbox.stage(component)
+            if 'systems' not in component:
+                build(defs, component)
+            do_manifest(component)
+            cache.cache(defs, component,
+                        full_root=component.get('kind') == "system")
+        finally:
+            cache.release(defs, component)
+        sandbox.remove(component)
 
 
 def build(defs, this):
@@ -148,7 +185,10 @@ def build(defs, this):
     if this.get('build-mode') != 'bootstrap':
         sandbox.ldconfig(this)
 
-    if this.get('repo'):
+    if this.get('repo') and this.get('tree') and \
+            app.settings.get('source-cache-gb'):
+        sandbox.stage_source(this)
+    elif this.get('repo'):
         repos.checkout(this['name'], this['repo'], this['ref'], this['build'])
 
     get_build_commands(defs, this)
@@ -170,6 +210,7 @@ def build(defs, this):
 
     with open(this['log'], "a") as logfile:
         logfile.write('Elapsed_time: %s\n' % app.elapsed(this['start-time']))
+    scheduler.record_build_time(this)
 
 
 def get_build_commands(defs, this):
@@ -206,16 +247,13 @@ def gather_integration_commands(defs, this):
     # 3. asciibetically sort them
     # 4. concat the lists
 
-    def _gather_recursively(component, commands):
+    all_commands = {}
+    for path in reversed(defs.walk(this, contents_only=True)):
+        component = defs.get(path)
         if 'system-integration' in component:
             for product, it in component['system-integration'].iteritems():
                 for name, cmdseq in it.iteritems():
-                    commands["%s-%s" % (name, product)] = cmdseq
-        for subcomponent in component.get('contents', []):
-            _gather_recursively(defs.get(subcomponent), commands)
-
-    all_commands = {}
-    _gather_recursively(this, all_commands)
+                    all_commands["%s-%s" % (name, product)] = cmdseq
     result = []
     for key in sorted(all_commands.keys()):
         result.extend(all_commands[key])
@@ -14,19 +14,47 @@
 #
 # =*= License: GPL-2 =*=
 
+import errno
+import fcntl
 import os
 import shutil
+import stat
 import app
 import re
 import hashlib
+import io
 import json
 import definitions
 import repos
 import buildsystem
 import utils
-from subprocess import call
+from subprocess import Popen, PIPE
 import requests
 import sys
+import threading
+import time
+import uuid
+
+
+# artifact compressors: (magic number, command to compress stdin to stdout)
+# gzip goes through pigz when it's available, to use more than one core,
+# and -n keeps the time out of the header so that artifacts are reproducible
+compressors = {
+    'gzip': (b'\x1f\x8b', ['pigz' if utils.which('pigz') else 'gzip', '-n']),
+    'lz4': (b'\x04\x22\x4d\x18', ['lz4', '-q']),
+    'xz': (b'\xfd7zXZ\x00', ['xz']),
+    'zstd': (b'\x28\xb5\x2f\xfd', ['zstd', '-q']),
+}
+
+# the first line of a manifest written by store()
+manifest_header = b'ybd-manifest\n'
+
+# file descriptors of unpacked trees locked by unpack(), by user name
+_unpacked_in_use = {}
+
+# lockfiles claimed by this instance, refreshed by _heartbeat()
+_claims = set()
+_heartbeat_pid = None
 
 
 def cache_key(defs, this):
@@ -37,6 +65,16 @@ def cache_key(defs, this):
     if definition.get('cache'):
         return definition['cache']
 
+    # work up from the bottom of the graph, so that the keys of everything
+    # this depends on are known by the time we need them
+    for path in defs.walk(definition):
+        if not defs.get(path).get('cache'):
+            _cache_key(defs, defs.get(path))
+
+    return definition['cache']
+
+
+def _cache_key(defs, definition):
     if definition.get('repo') and not definition.get('tree'):
         definition['tree'] = repos.get_tree(definition)
 
@@ -70,46 +108,768 @@ def cache_key(defs, this):
     return definition['cache']
 
 
+def resolve_trees(defs, target):
+    '''Fill in the missing trees for everything target depends on.
+
+    cache_key() needs the tree of every component with a repo. Looking them
+    up one at a time is slow with a cold trees.json, so we collect them
+    all first and let repos.get_trees() resolve them in bulk.
+
+    '''
+    missing = []
+    for path in defs.walk(target):
+        definition = defs.get(path)
+        if definition.get('repo') and not definition.get('tree'):
+            missing.append(definition)
+
+    if missing:
+        trees = repos.get_trees([(d['repo'], d['ref']) for d in missing])
+        for definition in missing:
+            definition['tree'] = trees.get((definition['repo'],
+                                            definition['ref']))
+        app.log(target, 'Resolved %s of %s trees' % (len(trees),
+                len(set((d['repo'], d['ref']) for d in missing))))
+
+
 def cache(defs, this, full_root=False):
     app.log(this, "Creating cache artifact")
     cachefile = os.path.join(app.settings['artifacts'], cache_key(defs, this))
+    if app.settings.get('artifact-store') == 'dedup':
+        store(this['sandbox'] if full_root else this['install'], cachefile)
+        app.log(this, 'Now stored as', cache_key(defs, this))
+        return
+
     if full_root:
-        shutil.make_archive(cachefile, 'tar', this['sandbox'])
-        os.rename('%s.tar' % cachefile, cachefile)
+        checksum = archive(this, this['sandbox'], cachefile,
+                           app.settings.get('system-compression', 'none'))
     else:
-        utils.set_mtime_recursively(this['install'])
-        shutil.make_archive(cachefile, 'gztar', this['install'])
-        os.rename('%s.tar.gz' % cachefile, cachefile)
+        checksum = archive(this, this['install'], cachefile,
+                           app.settings.get('compression', 'gzip'))
+    with open(cachefile + '.meta', 'a') as f:
+        f.write('sha256: %s\n' % checksum)
     app.log(this, 'Now cached as', cache_key(defs, this))
-    if os.fork() == 0:
-        upload(this, cachefile)
-        sys.exit()
+    upload(this, cachefile)
+
+
+def archive(this, root, cachefile, compression):
+    '''Write the tree at root to cachefile as a tarball.
+
+    The tarball is piped through the compressor for `compression`, which is
+    one of the keys of `compressors` or 'none'. 'compression-level' and
+    'compression-threads' from ybd.def are passed on where the compressor
+    supports them.
+
+    We read the compressed stream once, and from it write the file and
+    calculate the sha256 checksum, which is returned.
+
+    tar normalises the metadata as it goes, so the tree itself is not
+    touched: entries are in name order, every mtime is the default one,
+    owners are numeric and xattrs are left out. So the same tree gives
+    the same tarball on any host.
+
+    '''
+    tar = Popen(['tar', 'c', '--directory', root, '--format=gnu',
+                 '--sort=name', '--mtime=@%d' % utils.default_mtime,
+                 '--numeric-owner', '--no-acls', '--no-selinux',
+                 '--no-xattrs', '.'], stdout=PIPE)
+    processes = [tar]
+    if compression != 'none':
+        processes.append(Popen(_compress_command(this, compression),
+                               stdin=tar.stdout, stdout=PIPE))
+        tar.stdout.close()
+
+    tmpfile = cachefile + '.tmp'
+    sha = hashlib.sha256()
+    with open(tmpfile, 'wb') as f:
+        for block in iter(lambda: processes[-1].stdout.read(1024 * 1024),
+                          b''):
+            sha.update(block)
+            f.write(block)
+    processes[-1].stdout.close()
+
+    if [p for p in processes if p.wait()]:
+        os.remove(tmpfile)
+        app.exit(this, 'ERROR: Problem creating', cachefile)
+    os.rename(tmpfile, cachefile)
+    return sha.hexdigest()
+
+
+def _compress_command(this, compression):
+    if compression not in compressors:
+        app.exit(this, 'ERROR: unknown compression', compression)
+
+    command = list(compressors[compression][1])
+    level = app.settings.get('compression-level')
+    if level is not None:
+        command.append('-%s' % level)
+    threads = app.settings.get('compression-threads', 0)
+    if compression in ['xz', 'zstd']:
+        command.append('-T%s' % threads)
+    elif command[0] == 'pigz' and threads:
+        command.extend(['-p', str(threads)])
+    return command
+
+
+def _decompress_command(cachefile):
+    '''Return the command to decompress cachefile, or None for plain tar.'''
+    with open(cachefile, 'rb') as f:
+        header = f.read(8)
+    for name, (magic, command) in compressors.items():
+        if header.startswith(magic):
+            return [command[0], '-d', '-c']
+    return None
 
 
 def upload(this, cachefile):
-    url = app.settings['server'] + '/post'
-    params = {"upfile": os.path.basename(cachefile),
-              "folder": os.path.dirname(cachefile), "submit": "Submit"}
-    with open(cachefile, 'rb') as local_file:
-        try:
-            response = requests.post(url=url, data=params,
-                                     files={"file": local_file})
+    '''Upload cachefile to the artifact server, in the background.
+
+    The upload runs in a grandchild process, so that the build never waits
+    for the server, and nothing has to reap it. The artifact file on disk
+    is the spool for it. If the 'server' setting is a file:// url we just
+    copy the artifact into that directory, as a stand-in for a remote
+    cache. Upload failures are not fatal: we log them and carry on.
+
+    This reads the artifact back rather than taking it from archive()'s
+    stream, because feeding the upload from the stream ties tar to the
+    speed of the server, or means buffering the stream, which is what the
+    file already does. It was only just written, so the read is normally
+    served from the page cache.
+
+    '''
+    server = app.settings.get('server')
+    if not server:
+        return
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    status = 0
+    try:
+        if os.fork() == 0:
+            app.settings['pid'] = os.getpid()
+            if server.startswith('file://'):
+                _copy_artifact(cachefile, server[len('file://'):])
+            else:
+                _post_artifact(cachefile, server)
             app.log(this, 'Artifact uploaded')
-        except:
-            pass
+    except:
+        app.log(this, 'WARNING: artifact upload failed', server)
+        status = 1
+    sys.stdout.flush()
+    os._exit(status)
+
+
+def _copy_artifact(cachefile, directory):
+    path = os.path.join(directory, os.path.basename(cachefile))
+    tmpfile = _tmpname(path)
+    shutil.copyfile(cachefile, tmpfile)
+    os.rename(tmpfile, path)
+
+
+def _post_artifact(cachefile, server):
+    with open(cachefile, 'rb') as f:
+        body = _MultipartFile(f, os.path.basename(cachefile),
+                              [('upfile', os.path.basename(cachefile)),
+                               ('folder', app.settings['artifacts']),
+                               ('submit', 'Submit')])
+        response = requests.post(url=server + '/post', data=body,
+                                 headers={'Content-Type': body.content_type},
+                                 timeout=60)
+    response.raise_for_status()
+
 
+class _MultipartFile(object):
+    '''A multipart/form-data body for fields plus file f, read like a file.
 
-def unpack(defs, this):
+    requests streams this from disk with a Content-Length, as the server
+    expects, rather than building the whole body in memory as it does for
+    files=.
+
+    '''
+
+    def __init__(self, f, filename, fields):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        head = ''.join('--%s\r\nContent-Disposition: form-data; '
+                       'name="%s"\r\n\r\n%s\r\n' % (boundary, key, value)
+                       for key, value in fields)
+        head += ('--%s\r\nContent-Disposition: form-data; name="file"; '
+                 'filename="%s"\r\nContent-Type: application/octet-stream'
+                 '\r\n\r\n' % (boundary, filename))
+        tail = '\r\n--%s--\r\n' % boundary
+        self.parts = [io.BytesIO(head.encode('utf-8')), f,
+                      io.BytesIO(tail.encode('utf-8'))]
+        self.len = (len(head.encode('utf-8')) + os.fstat(f.fileno()).st_size +
+                    len(tail.encode('utf-8')))
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        data = b''
+        while self.parts and len(data) < size:
+            block = self.parts[0].read(size - len(data))
+            if block:
+                data += block
+            else:
+                self.parts.pop(0)
+        return data
+
+
+def unpack(defs, this, user=None):
+    '''Return the path of this artifact's unpacked tree, unpacking if need be.
+
+    Unpacked trees are kept under 'artifacts' with an '.unpacked' suffix.
+    Each use touches the directory, so its mtime shows when it was last
+    used, and if `user` is given we hold a shared lock on the directory
+    until release_unpacked(user) so that cull_unpacked() leaves it alone.
+
+    '''
     cachefile = get_cache(defs, this)
-    if cachefile:
-        unpackdir = cachefile + '.unpacked'
-        if not os.path.exists(unpackdir):
-            os.makedirs(unpackdir)
-            if call(['tar', 'xf', cachefile, '--directory', unpackdir]):
-                app.exit(this, 'ERROR: Problem unpacking', cachefile)
-        return unpackdir
-
-    app.exit(this, 'ERROR: Cached artifact not found')
+    if not cachefile:
+        app.exit(this, 'ERROR: Cached artifact not found')
+
+    unpackdir = cachefile + '.unpacked'
+    _use_tree(unpackdir,
+              lambda tmpdir: extract(this, cachefile, tmpdir),
+              user)
+    return unpackdir
+
+
+def unpack_source(this, user=None):
+    '''Return the path of a snapshot of this's source, checking it out if
+    need be.
+
+    Snapshots are kept in 'caches'/sources. With 'checkout: export' they
+    are named by the tree SHA from the cache key, so a tree checked out
+    once is reused by every build of it, whatever the arch, key or ref.
+    A clone includes .git, with HEAD at the commit that git describe uses
+    for the version, so clones are named by the commit SHA plus '.git'.
+    Snapshots include submodules, and their mtimes are already normalised.
+    Like unpacked artifacts, they are locked while in use and culled least
+    recently used first, to 'source-cache-gb'.
+
+    '''
+    if app.settings.get('checkout') == 'export':
+        name = this['tree']
+    else:
+        gitdir = repos.get_mirror(this['name'], this['repo'], this['ref'])
+        name = repos.cat_file(gitdir, this['ref'] + '^{commit}')[0] + '.git'
+    sourcedir = os.path.join(app.settings['caches'], 'sources', name)
+    _use_tree(sourcedir, lambda tmpdir: repos.checkout(
+        this['name'], this['repo'], this['ref'], tmpdir), user)
+    if user:
+        cull_sources()
+    return sourcedir
+
+
+def _use_tree(path, populate, user):
+    '''Create path with populate(tmpdir) if it doesn't exist, and use it.
+
+    The tree is populated in a temporary directory which is renamed into
+    place, so other instances only ever see complete trees. If `user` is
+    given a shared lock is held on it until release_unpacked(user).
+
+    '''
+    while True:
+        if not os.path.exists(path):
+            tmpdir = _tmpname(path)
+            os.makedirs(tmpdir)
+            populate(tmpdir)
+            with open(path + '.size', 'w') as f:
+                f.write('%s\n' % _tree_size(tmpdir))
+            try:
+                os.rename(tmpdir, path)
+            except OSError:
+                # another instance got there first
+                shutil.rmtree(tmpdir)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # check that it wasn't culled while we waited for the lock
+        try:
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                break
+        except OSError:
+            pass
+        os.close(fd)
+
+    os.utime(path, None)
+    if user is None:
+        os.close(fd)
+    else:
+        _unpacked_in_use.setdefault(user['name'], []).append(fd)
+
+
+def release_unpacked(user):
+    '''Drop the locks held by unpack() and unpack_source() for user.'''
+    for fd in _unpacked_in_use.pop(user['name'], []):
+        os.close(fd)
+
+
+def cull_unpacked(report=False):
+    '''Remove the least recently used unpacked trees until within budget.
+
+    The budget is 'unpacked-cache-gb' in ybd.def; 0 means no limit. Trees
+    locked by a running build are skipped.
+
+    '''
+    artifacts = app.settings['artifacts']
+    names = os.listdir(artifacts)
+    _remove_stale_tmpdirs(artifacts, names)
+    paths = [os.path.join(artifacts, name) for name in names
+             if name.endswith('.unpacked')]
+    _cull('UNPACKED', paths, app.settings.get('unpacked-cache-gb', 0), report)
+
+
+def cull_sources(report=False):
+    '''Remove the least recently used source snapshots until within budget.
+
+    The budget is 'source-cache-gb' in ybd.def.
+
+    '''
+    sources = os.path.join(app.settings['caches'], 'sources')
+    if not os.path.isdir(sources):
+        return
+    names = os.listdir(sources)
+    _remove_stale_tmpdirs(sources, names)
+    paths = [os.path.join(sources, name) for name in names
+             if re.match(r'^[0-9a-f]{40}(\.git)?$', name)]
+    _cull('SOURCES', paths, app.settings.get('source-cache-gb', 0), report)
+
+
+def cull_objects(report=False):
+    '''Remove objects from the store which no manifest refers to.
+
+    Objects written or reused by a store() in the last 'object-grace-hours'
+    (default 24) are kept, because its manifest may not be there yet.
+    store() sets the mtime of every object, so we go by the ctime.
+
+    '''
+    artifacts = app.settings['artifacts']
+    objects = os.path.join(artifacts, 'objects')
+    if not os.path.isdir(objects):
+        return
+
+    used = set()
+    for name in os.listdir(artifacts):
+        path = os.path.join(artifacts, name)
+        if not os.path.isfile(path) or not _is_manifest(path):
+            continue
+        with open(path) as f:
+            f.readline()
+            for entry in json.load(f):
+                if stat.S_ISREG(entry[1]):
+                    used.add(_object_path(entry[4], *entry[1:4]))
+
+    grace = app.settings.get('object-grace-hours', 24) * 3600
+    count = size = kept = 0
+    for dirname, subdirs, filenames in os.walk(objects):
+        for filename in filenames:
+            path = os.path.join(dirname, filename)
+            if path in used:
+                kept += 1
+                continue
+            try:
+                st = os.lstat(path)
+                if time.time() - st.st_ctime < grace:
+                    kept += 1
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            count += 1
+            size += st.st_blocks * 512
+    if report or count:
+        app.log('OBJECTS', 'Removed %s unused objects, %.1fGB, kept' %
+                (count, size / 1024.0 ** 3), kept)
+
+
+def _is_manifest(path):
+    with open(path, 'rb') as f:
+        return f.read(len(manifest_header)) == manifest_header
+
+
+def _tmpname(path):
+    '''Return a temporary name for path, unique to this process and thread.
+
+    Forked builds share the 'instance' of the ybd which started them, so
+    the pid and thread are added to it.
+
+    '''
+    return '%s.%s:%s.%s' % (path, _hostname(), os.getpid(),
+                            threading.current_thread().ident)
+
+
+def _remove_stale_tmpdirs(directory, names):
+    '''Remove trees in directory left by processes on this host which died.
+
+    These are the trees named by _tmpname(), which were being populated by
+    _use_tree() or deleted by _remove_cached_tree() when ybd was killed.
+
+    '''
+    tmpname = re.compile(r'\.%s:(\d+)(\.|$)' % re.escape(_hostname()))
+    for name in names:
+        match = tmpname.search(name)
+        path = os.path.join(directory, name)
+        if match and not _process_exists(int(match.group(1))) and \
+                os.path.isdir(path) and not os.path.islink(path):
+            app.log('CACHE', 'Removing stale', path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _hostname():
+    return app.settings['instance'].rsplit(':', 1)[0]
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+    return True
+
+
+def _cull(label, paths, budget_gb, report):
+    budget = budget_gb * 1024 ** 3
+    entries = []
+    for path in paths:
+        try:
+            entries.append((os.stat(path).st_mtime, path, _cached_size(path)))
+        except OSError:
+            pass
+
+    total = sum(size for mtime, path, size in entries)
+    if report:
+        app.log(label, '%s trees using %.1fGB, budget is' %
+                (len(entries), total / 1024.0 ** 3),
+                '%sGB' % budget_gb if budget else 'unlimited')
+
+    culled = 0
+    for mtime, path, size in sorted(entries):
+        if not budget or total <= budget:
+            break
+        if _remove_cached_tree(path):
+            total -= size
+            culled += size
+    if culled:
+        app.log(label, 'Removed %.1fGB of trees, now using' %
+                (culled / 1024.0 ** 3), '%.1fGB' % (total / 1024.0 ** 3))
+
+
+def _remove_cached_tree(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close(fd)
+        return False
+
+    deleting = _tmpname(path) + '.deleting'
+    os.rename(path, deleting)
+    os.close(fd)
+    shutil.rmtree(deleting)
+    try:
+        os.remove(path + '.size')
+    except OSError:
+        pass
+    return True
+
+
+def _cached_size(path):
+    try:
+        with open(path + '.size') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        size = _tree_size(path)
+        with open(path + '.size', 'w') as f:
+            f.write('%s\n' % size)
+        return size
+
+
+def _tree_size(root):
+    size = 0
+    for dirname, subdirs, filenames in os.walk(root):
+        for name in [dirname] + [os.path.join(dirname, f) for f in filenames]:
+            size += os.lstat(name).st_blocks * 512
+    return size
+
+
+def extract(this, cachefile, directory):
+    '''Unpack the artifact at cachefile into directory.
+
+    If the artifact's .meta records a checksum, we check it as we go.
+
+    '''
+    if _is_manifest(cachefile):
+        unstore(cachefile, directory)
+        return
+
+    decompress = _decompress_command(cachefile)
+    tar = ['tar', 'x', '--directory', directory]
+    if decompress is None:
+        processes = [Popen(tar, stdin=PIPE)]
+    else:
+        processes = [Popen(decompress, stdin=PIPE, stdout=PIPE)]
+        processes.append(Popen(tar, stdin=processes[0].stdout))
+        processes[0].stdout.close()
+
+    sha = hashlib.sha256()
+    try:
+        with open(cachefile, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+                processes[0].stdin.write(block)
+    except IOError:
+        pass
+    processes[0].stdin.close()
+
+    if [p for p in processes if p.wait()]:
+        app.exit(this, 'ERROR: Problem unpacking', cachefile)
+
+    checksum = _checksum(cachefile)
+    if checksum and checksum != sha.hexdigest():
+        app.exit(this, 'ERROR: checksum does not match for', cachefile)
+
+
+def _checksum(cachefile):
+    '''Return the sha256 recorded in the artifact's .meta, if any.'''
+    try:
+        with open(cachefile + '.meta') as f:
+            for line in f:
+                if line.startswith('sha256: '):
+                    return line.split()[1]
+    except IOError:
+        pass
+    return None
+
+
+def store(root, cachefile):
+    '''Put the tree at root into the object store, with cachefile as manifest.
+
+    Each regular file is stored once, named by the hash of its contents plus
+    the metadata that hardlinks share (mode, uid, gid), and all stored files
+    have the default mtime. The manifest lists every entry in the tree, and
+    unstore() recreates the tree from the objects.
+
+    '''
+    manifest = []
+    for dirname, subdirs, filenames in os.walk(root):
+        subdirs.sort()
+        paths = [dirname] + [os.path.join(dirname, f)
+                             for f in sorted(filenames)]
+        # symlinks to directories are listed in subdirs, but not walked
+        paths += [os.path.join(dirname, d) for d in subdirs
+                  if os.path.islink(os.path.join(dirname, d))]
+        for path in paths:
+            st = os.lstat(path)
+            entry = [os.path.relpath(path, root), st.st_mode, st.st_uid,
+                     st.st_gid]
+            if stat.S_ISREG(st.st_mode):
+                entry.append(_store_object(path, st))
+            elif stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                entry.append(st.st_rdev)
+            manifest.append(entry)
+
+    with open(cachefile + '.tmp', 'w') as f:
+        f.write(manifest_header.decode())
+        json.dump(manifest, f)
+    os.rename(cachefile + '.tmp', cachefile)
+
+
+def unstore(cachefile, directory):
+    '''Recreate the tree listed in a manifest written by store().
+
+    Files are copied out of the store, with reflinks where the filesystem
+    can do them, and never hardlinked. Unpacked trees are staged into
+    sandboxes with cp -l, so a hardlink would let a build which edits a
+    staged file in place change the object, and every artifact using it.
+
+    '''
+    with open(cachefile) as f:
+        f.readline()
+        manifest = json.load(f)
+
+    dirs = []
+    for entry in manifest:
+        path, mode, uid, gid = entry[:4]
+        dest = os.path.join(directory, path)
+        if stat.S_ISDIR(mode):
+            if path != '.':
+                os.mkdir(dest)
+            dirs.append((dest, mode, uid, gid))
+        elif stat.S_ISREG(mode):
+            _unstore_object(_object_path(entry[4], mode, uid, gid), dest)
+        elif stat.S_ISLNK(mode):
+            os.symlink(entry[4], dest)
+            os.lchown(dest, uid, gid)
+        else:
+            # devices have their st_rdev in the manifest, fifos don't
+            os.mknod(dest, mode, entry[4] if len(entry) > 4 else 0)
+            os.chown(dest, uid, gid)
+
+    # set directory metadata last, in case any of them are read-only
+    for dest, mode, uid, gid in reversed(dirs):
+        os.chown(dest, uid, gid)
+        os.chmod(dest, stat.S_IMODE(mode))
+        os.utime(dest, (utils.default_mtime, utils.default_mtime))
+
+
+def _unstore_object(objfile, dest):
+    st = os.stat(objfile)
+    utils.copy_file(objfile, dest)
+    os.chown(dest, st.st_uid, st.st_gid)
+    # chown clears setuid and setgid, so set the mode again
+    os.chmod(dest, stat.S_IMODE(st.st_mode))
+
+
+def _object_path(digest, mode, uid, gid):
+    name = '%s.%o.%s.%s' % (digest, stat.S_IMODE(mode), uid, gid)
+    return os.path.join(app.settings['artifacts'], 'objects', name[:2],
+                        name[2:])
+
+
+def _store_object(path, st):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    objfile = _object_path(digest, st.st_mode, st.st_uid, st.st_gid)
+    if not os.path.exists(objfile):
+        try:
+            os.makedirs(os.path.dirname(objfile))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(objfile)):
+                raise
+        tmpfile = _tmpname(objfile)
+        linked = False
+        # only take over a file nothing else links to, such as one from
+        # make install, never one staged in from another artifact
+        if st.st_nlink == 1:
+            try:
+                os.link(path, tmpfile)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            utils.copy_file(path, tmpfile)
+            os.chown(tmpfile, st.st_uid, st.st_gid)
+            os.chmod(tmpfile, stat.S_IMODE(st.st_mode))
+        os.utime(tmpfile, (utils.default_mtime, utils.default_mtime))
+        os.rename(tmpfile, objfile)
+    else:
+        # this changes the ctime, which tells cull_objects() it is in use
+        os.utime(objfile, (utils.default_mtime, utils.default_mtime))
+
+    return digest
+
+
+def claim(defs, this):
+    '''Try to claim the build of this for our instance. Return True on success.
+
+    A claim is a '.lock' file next to the artifact, containing the id of the
+    instance which made it. We create it with os.link() so that claiming is
+    atomic over NFS too. A claim from a dead process on this host, or one
+    which has not been refreshed for 'lock-timeout' seconds, is broken.
+
+    '''
+    lockfile = _lockfile(defs, this)
+    instance = app.settings['instance']
+    tmpfile = '%s.%s' % (lockfile, instance)
+    with open(tmpfile, 'w') as f:
+        f.write(instance)
+    try:
+        for attempt in [1, 2]:
+            try:
+                os.link(tmpfile, lockfile)
+            except OSError:
+                pass
+            # over NFS, link() can fail even though it worked
+            if (os.stat(tmpfile).st_nlink == 2 or
+                    _claimant(lockfile) == instance):
+                _claims.add(lockfile)
+                _start_heartbeat()
+                return True
+            if not _claim_is_stale(lockfile, tmpfile):
+                return False
+            app.log(this, 'Breaking stale claim by', _claimant(lockfile))
+            try:
+                os.remove(lockfile)
+            except OSError:
+                pass
+        return False
+    finally:
+        os.remove(tmpfile)
+
+
+def release(defs, this):
+    '''Drop our claim on this, if we have one.'''
+    lockfile = _lockfile(defs, this)
+    _claims.discard(lockfile)
+    if _claimant(lockfile) == app.settings['instance']:
+        os.remove(lockfile)
+
+
+def _lockfile(defs, this):
+    return os.path.join(app.settings['artifacts'],
+                        cache_key(defs, this) + '.lock')
+
+
+def _claimant(lockfile):
+    try:
+        with open(lockfile) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _claim_is_stale(lockfile, tmpfile):
+    claimant = _claimant(lockfile)
+    if claimant is None:
+        return True
+
+    host, pid = claimant.rsplit(':', 1)
+    if host == _hostname() and not _process_exists(int(pid)):
+        return True
+
+    # compare against tmpfile rather than time.time(), so that clock skew
+    # between NFS clients doesn't matter
+    try:
+        age = os.stat(tmpfile).st_mtime - os.stat(lockfile).st_mtime
+    except OSError:
+        return True
+    return age > app.settings['lock-timeout']
+
+
+def _start_heartbeat():
+    global _heartbeat_pid
+    if _heartbeat_pid != os.getpid():
+        _heartbeat_pid = os.getpid()
+        thread = threading.Thread(target=_heartbeat)
+        thread.daemon = True
+        thread.start()
+
+
+def _heartbeat():
+    '''Keep our claims fresh, so other instances know we're still alive.'''
+    while True:
+        time.sleep(app.settings['lock-timeout'] / 4)
+        for lockfile in list(_claims):
+            try:
+                os.utime(lockfile, None)
+            except OSError:
+                _claims.discard(lockfile)
 
 
 def get_cache(defs, this):
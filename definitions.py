@@ -18,8 +18,138 @@ import yaml
 import os
 import app
 import cache
-from subprocess import check_output, PIPE
+import repos
 import hashlib
+import sys
+from multiprocessing import Pool, cpu_count
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+if sys.version_info.major >= 3:
+    from sys import intern
+
+# libyaml's loader is several times faster than the pure python one
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# below this many files to parse, starting a Pool costs more than it saves.
+# tools/bench-definitions.py puts the median at 220-260 files, from runs
+# ranging over 170-350, so this is a round number in the middle.
+_parallel_parse_min = 250
+
+# keys which most definitions have, or which assembly fills in, and which
+# a Definition keeps in slots rather than in a dict
+_fields = ['name', 'path', 'kind', 'repo', 'ref', 'unpetrify-ref', 'tree',
+           'cache', 'build-system', 'build-mode', 'prefix', 'build-depends',
+           'contents', 'arch', 'sandbox', 'build', 'install', 'baserockdir',
+           'tmp', 'log', 'start-time']
+_slots = dict((key, key.replace('-', '_')) for key in _fields)
+_missing = object()
+
+
+def _intern(value):
+    if type(value) is str:
+        return intern(value)
+    if type(value) is list:
+        return [intern(it) if type(it) is str else it for it in value]
+    return value
+
+
+class Definition(object):
+    '''A compact definition, which can be used like a dict.
+
+    The keys in _fields are kept in slots and anything else goes in a dict
+    which is only created if needed. Strings are interned as they are
+    stored, since the same paths, repos and build-systems are repeated
+    across many definitions. Definitions uses these instead of plain dicts
+    if 'compact-definitions' is set.
+
+    '''
+    __slots__ = tuple(_slots[key] for key in _fields) + ('_extra',)
+
+    def __init__(self, contents=None):
+        self._extra = None
+        for key, value in (contents or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in _slots:
+            setattr(self, _slots[key], _intern(value))
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[_intern(key)] = _intern(value)
+
+    def __delitem__(self, key):
+        try:
+            if key in _slots:
+                delattr(self, _slots[key])
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in _slots:
+            return hasattr(self, _slots[key])
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        # don't count keys just to test a definition, it always has a path
+        return True
+
+    __bool__ = __nonzero__
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        keys = [key for key in _fields if hasattr(self, _slots[key])]
+        return keys + list(self._extra or [])
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        attribute = _slots.get(key)
+        if attribute is not None:
+            return getattr(self, attribute, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
 
 
 class Definitions(object):
@@ -27,7 +157,8 @@ class Definitions(object):
     def __init__(self):
         '''Load all definitions from `cwd` tree.'''
         self._definitions = {}
-        self._trees = {}
+        self._index = None
+        self._compact = app.settings.get('compact-definitions', False)
 
         json_schema = self._load(app.settings.get('json-schema'))
         definitions_schema = self._load(app.settings.get('defs-schema'))
@@ -36,7 +167,7 @@ class Definitions(object):
             js.validate(json_schema, json_schema)
             js.validate(definitions_schema, json_schema)
 
-        things_have_changed = not self._check_trees()
+        paths = []
         for dirname, dirnames, filenames in os.walk('.'):
             filenames.sort()
             dirnames.sort()
@@ -44,28 +175,101 @@ class Definitions(object):
                 dirnames.remove('.git')
             for filename in filenames:
                 if filename.endswith(('.def', '.morph')):
-                    contents = self._load(os.path.join(dirname, filename))
-                    if contents is not None:
-                        if things_have_changed and definitions_schema:
-                            app.log(filename, 'Validating schema')
-                            js.validate(contents, definitions_schema)
-                        self._tidy(contents)
-
-        if self._check_trees():
-            for name in self._definitions:
-                self._definitions[name]['tree'] = self._trees.get(name)
+                    paths.append(os.path.join(dirname, filename))
+
+        parse_cache = self._load_parse_cache()
+        parsed = {}
+        loaded = self._load_all(paths, parse_cache, parsed)
+        for path in paths:
+            contents, changed = loaded[path]
+            if contents is not None:
+                if changed and definitions_schema:
+                    app.log(path, 'Validating schema')
+                    js.validate(contents, definitions_schema)
+                self._tidy(contents)
+        self._save_parse_cache(parsed)
+
+        # trees for SHA1 refs never change, so we can have the ones which
+        # repos.get_trees() resolved last time
+        trees = repos.cached_trees()
+        for definition in self._definitions.values():
+            tree = trees.get((definition.get('repo'), definition.get('ref')))
+            if tree is not None:
+                definition['tree'] = tree
 
     def _load(self, path):
-        try:
-            with open(path) as f:
-                text = f.read()
-            contents = yaml.safe_load(text)
-        except:
+        contents = _parse(path)
+        if contents is None:
             app.log('DEFINITIONS', 'WARNING: problem loading', path)
-            return None
-        contents['path'] = path[2:]
         return contents
 
+    def _load_all(self, paths, parse_cache, parsed):
+        '''Load definition files, using the parse cache if we can.
+
+        The cache holds the parsed contents of each file, keyed by path and
+        checked against mtime and size, or failing that the sha1 of the
+        contents. Files which aren't in the cache are parsed by a pool of
+        processes.
+
+        Returns {path: (contents, changed)}, where changed is True if we
+        had to parse the file. The cache entries to keep go into `parsed`.
+
+        '''
+        loaded = {}
+        todo = []
+        for path in paths:
+            st = os.stat(path)
+            entry = parse_cache.get(path)
+            if entry and entry[:2] == (st.st_mtime, st.st_size):
+                parsed[path] = entry
+                loaded[path] = pickle.loads(entry[3]), False
+                continue
+
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            if entry and entry[2] == digest:
+                parsed[path] = (st.st_mtime, st.st_size) + entry[2:]
+                loaded[path] = pickle.loads(entry[3]), False
+            else:
+                todo.append((path, (st.st_mtime, st.st_size, digest)))
+
+        if len(todo) >= _parallel_parse_min and cpu_count() > 1:
+            pool = Pool()
+            try:
+                blobs = pool.map(_parse_to_pickle, [p for p, key in todo],
+                                 chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            blobs = [_parse_to_pickle(path) for path, key in todo]
+
+        for (path, key), blob in zip(todo, blobs):
+            if blob is None:
+                app.log('DEFINITIONS', 'WARNING: problem loading', path)
+                loaded[path] = None, True
+            else:
+                parsed[path] = key + (blob,)
+                loaded[path] = pickle.loads(blob), True
+
+        return loaded
+
+    def _load_parse_cache(self):
+        try:
+            with open('.parsed', 'rb') as f:
+                version, parse_cache = pickle.load(f)
+            if version == sys.version_info.major:
+                return parse_cache
+        except:
+            pass
+        return {}
+
+    def _save_parse_cache(self, parsed):
+        tmpfile = '.parsed.%s' % app.settings['instance']
+        with open(tmpfile, 'wb') as f:
+            pickle.dump((sys.version_info.major, parsed), f, 2)
+        os.rename(tmpfile, '.parsed')
+
     def _tidy(self, definition):
         '''Insert a definition and its contents into the dictionary.
 
@@ -155,6 +359,8 @@ class Definitions(object):
                     app.log(definition,
                             '%s | %s' % (existing_definition.get(key),
                                          definition[key]))
+        elif self._compact:
+            self._definitions[definition['path']] = Definition(definition)
         else:
             self._definitions[definition['path']] = definition
 
@@ -170,35 +376,144 @@ class Definitions(object):
         to the 'path' value in the given dict.
 
         '''
-        if type(definition) is str:
-            return self._definitions.get(definition)
+        if hasattr(definition, 'get'):
+            return self._definitions.get(definition['path'])
 
-        return self._definitions.get(definition['path'])
+        return self._definitions.get(definition)
 
-    def _check_trees(self):
-        try:
-            with app.chdir(app.settings['defdir']):
-                checksum = check_output('ls -lRA */', shell=True)
-            checksum = hashlib.md5(checksum).hexdigest()
-            with open('.trees') as f:
-                text = f.read()
-            self._trees = yaml.safe_load(text)
-            if self._trees.get('.checksum') == checksum:
-                return True
-        except:
-            if os.path.exists('.trees'):
-                os.remove('.trees')
-            self._trees = {}
-            return False
-
-    def save_trees(self):
-        with app.chdir(app.settings['defdir']):
-            checksum = check_output('ls -lRA */', shell=True)
-        checksum = hashlib.md5(checksum).hexdigest()
-        self._trees = {'.checksum': checksum}
-        for name in self._definitions:
-            if self._definitions[name].get('tree') is not None:
-                self._trees[name] = self._definitions[name]['tree']
-
-        with open(os.path.join(os.getcwd(), '.trees'), 'w') as f:
-            f.write(yaml.dump(self._trees, default_flow_style=False))
+    def dependencies(self, definition):
+        '''Return the paths `definition` depends on directly.
+
+        That is its build-depends, its contents and, for clusters, its
+        systems and their subsystems. Missing definitions are left out.
+
+        '''
+        return self._get_index()['depends'].get(self.get(definition)['path'],
+                                                ())
+
+    def reverse_dependencies(self, definition):
+        '''Return the set of paths which depend directly on `definition`.'''
+        return self._get_index()['rdepends'].get(
+            self.get(definition)['path'], set())
+
+    def walk(self, definition, contents_only=False):
+        '''Return everything `definition` depends on, in topological order.
+
+        Dependencies come before the definitions which need them, and
+        `definition` itself is last. With `contents_only`, only follow
+        'contents', eg to find everything that goes into a system.
+
+        '''
+        index = self._get_index()
+        path = self.get(definition)['path']
+        if (path, contents_only) not in index['walk']:
+            if contents_only:
+                edges = lambda p: [it for it in
+                                   self._definitions[p].get('contents', [])
+                                   if it in self._definitions]
+            else:
+                edges = lambda p: index['depends'].get(p, ())
+            index['walk'][(path, contents_only)] = self._post_order(path,
+                                                                    edges)
+        return index['walk'][(path, contents_only)]
+
+    def install_order(self, definition):
+        '''Return the paths to install in order to install `definition`.
+
+        These are the build-depends which have the same build-mode as the
+        definition that needs them, and contents which aren't bootstrap
+        chunks, found recursively, in the order they should be installed.
+        `definition` itself is last.
+
+        '''
+        index = self._get_index()
+        path = self.get(definition)['path']
+        if path not in index['install']:
+            index['install'][path] = self._post_order(path, self._installs)
+        return index['install'][path]
+
+    def _installs(self, path):
+        definition = self._definitions[path]
+        mode = definition.get('build-mode', 'staging')
+        result = []
+        for it in definition.get('build-depends', []):
+            dependency = self._definitions.get(it)
+            if dependency and dependency.get('build-mode', 'staging') == mode:
+                result.append(it)
+        for it in definition.get('contents', []):
+            content = self._definitions.get(it)
+            if content and content.get('build-mode', 'staging') != 'bootstrap':
+                result.append(it)
+        return result
+
+    def _post_order(self, path, edges):
+        '''Walk the graph from path without recursing, dependencies first.'''
+        result = []
+        seen = set([path])
+        stack = [(path, iter(edges(path)))]
+        while stack:
+            current, children = stack[-1]
+            for child in children:
+                if child not in seen:
+                    seen.add(child)
+                    stack.append((child, iter(edges(child))))
+                    break
+            else:
+                stack.pop()
+                result.append(current)
+        return tuple(result)
+
+    def _get_index(self):
+        '''Index the dependency graph, so callers don't have to walk it.
+
+        Definitions don't change once they are loaded, so this is built
+        once, the first time it is needed. Walks and install orders are
+        added as they are asked for.
+
+        '''
+        if self._index is not None:
+            return self._index
+
+        depends = {}
+        rdepends = {}
+        for path, definition in self._definitions.items():
+            result = []
+
+            def add_systems(system):
+                result.append(system.get('path', 'BROKEN'))
+                for subsystem in system.get('subsystems', []):
+                    add_systems(subsystem)
+
+            for it in (definition.get('build-depends', []) +
+                       definition.get('contents', [])):
+                result.append(it)
+            for system in definition.get('systems', []):
+                add_systems(system)
+
+            depends[path] = tuple(it for it in result
+                                  if it in self._definitions)
+            for it in depends[path]:
+                rdepends.setdefault(it, set()).add(path)
+
+        self._index = {'depends': depends, 'rdepends': rdepends,
+                       'walk': {}, 'install': {}}
+        return self._index
+
+
+def _parse(path):
+    try:
+        with open(path) as f:
+            text = f.read()
+        contents = yaml.load(text, Loader=SafeLoader)
+    except:
+        return None
+    contents['path'] = path[2:]
+    return contents
+
+
+def _parse_to_pickle(path):
+    '''Parse a definition file in a worker, returning pickled contents.'''
+    contents = _parse(path)
+    if contents is None:
+        return None
+    return pickle.dumps(contents, 2)
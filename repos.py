@@ -15,27 +15,52 @@
 # =*= License: GPL-2 =*=
 
 
+import atexit
+import errno
+import fcntl
 import os
 import json
 import re
 import shutil
+import signal
 import string
-from subprocess import call, check_output
+import tempfile
+from multiprocessing.pool import ThreadPool
+from subprocess import call, check_output, Popen, PIPE
 import sys
+import threading
+from collections import OrderedDict
 
 import app
+import cache
 import utils
 
+# {(pid, gitdir): (process, lock)} of long-lived cat-files, see cat_file(),
+# least recently used first. Only the newest _cat_files_max are kept open.
+_cat_files = OrderedDict()
+_cat_files_lock = threading.Lock()
+_cat_files_max = 32
+
+# pids of prefetch children we haven't waited for, see prefetch()
+_prefetches = []
+
+# {host: semaphore} limiting concurrent downloads, see _server_slot()
+_servers = {}
+_servers_lock = threading.Lock()
+
 
 if sys.version_info.major == 2:
     # For compatibility with Python 2.
     from ConfigParser import RawConfigParser
     from StringIO import StringIO
-    from urllib2 import urlopen
+    from urllib2 import urlopen, Request, HTTPError
+    from urlparse import urlparse
 else:
     from configparser import RawConfigParser
     from io import StringIO
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse
 
 
 def get_repo_url(repo):
@@ -64,15 +89,21 @@ def get_repo_name(repo):
 
 def get_version(gitdir, ref='HEAD'):
     try:
-        with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-            described = check_output(['git', 'describe', '--tags', '--dirty'],
-                                     stderr=fnull)[0:-1]
-            last_tag = check_output(['git', 'describe', '--abbrev=0',
-                                     '--tags', ref], stderr=fnull)[0:-1]
-            commits = check_output(['git', 'rev-list', last_tag + '..' + ref,
-                                    '--count'])[0:-1]
-        result = "%s %s (%s + %s commits)" % (ref[:8], described, last_tag,
-                                              commits)
+        with open(os.devnull, "w") as fnull:
+            # --dirty needs a work tree, and gitdir may be a bare mirror
+            describe = ['--dirty'] if ref == 'HEAD' else [ref]
+            described = check_output(['git', 'describe', '--tags', '--long'] +
+                                     describe, stderr=fnull, cwd=gitdir,
+                                     universal_newlines=True).strip()
+        dirty = ''
+        if described.endswith('-dirty'):
+            described, dirty = described[:-6], '-dirty'
+        last_tag, commits, sha = described.rsplit('-', 2)
+        if commits == '0':
+            # that's what describe without --long would have said
+            described = last_tag
+        result = "%s %s (%s + %s commits)" % (ref[:8], described + dirty,
+                                              last_tag, commits)
     except:
         result = ref[:8] + " (No tag found)"
 
@@ -92,25 +123,229 @@ def get_tree(this):
                 return tree
         except:
             app.log(this, 'WARNING: no tree from cache-server', ref)
-            mirror(this['name'], this['repo'])
+            get_mirror(this['name'], this['repo'], ref)
+
+    if cat_file(gitdir, ref + '^{object}') is None:
+        # can't resolve this ref. is it upstream?
+        app.log(this, 'Fetching from upstream to resolve %s' % ref)
+        fetch(gitdir)
+
+    tree = cat_file(gitdir, ref + '^{tree}')
+    if tree is None:
+        # either we don't have a git dir, or ref is not unique
+        # or ref does not exist
+        app.exit(this, 'ERROR: could not find tree for ref', (ref, gitdir))
+    return tree[0]
+
+
+def get_trees(pairs):
+    '''Return {(repo, ref): tree} for as many of `pairs` as we can resolve.
+
+    Refs in local mirrors are resolved with cat_file(), from a thread per
+    mirror, and we ask cache-server about the rest from a pool of
+    threads. Anything we can't resolve is left for get_tree().
+
+    Trees for refs which are full SHA1s can never change, so we keep them
+    in 'caches'/trees.json for next time.
+
+    '''
+    memo = _load_tree_memo()
+    trees = {}
+    mirrors = {}
+    remote = []
+    for repo, ref in set(pairs):
+        if '%s %s' % (repo, ref) in memo:
+            trees[(repo, ref)] = memo['%s %s' % (repo, ref)]
+            continue
+        gitdir = os.path.join(app.settings['gits'], get_repo_name(repo))
+        if os.path.exists(gitdir):
+            mirrors.setdefault(gitdir, []).append((repo, ref))
+        else:
+            remote.append((repo, ref))
+
+    pool = ThreadPool(16)
+    try:
+        for result in pool.map(_trees_from_mirror, mirrors.items()):
+            trees.update(result)
+        for pair, tree in zip(remote, pool.map(_tree_from_server, remote)):
+            if tree:
+                trees[pair] = tree
+    finally:
+        pool.close()
+        pool.join()
+        close_cat_files()
+
+    for (repo, ref), tree in trees.items():
+        if re.match('^[0-9a-f]{40}$', ref):
+            memo['%s %s' % (repo, ref)] = tree
+    _save_tree_memo(memo)
+
+    return trees
+
+
+def _trees_from_mirror(item):
+    gitdir, pairs = item
+    trees = {}
+    for repo, ref in pairs:
+        tree = cat_file(gitdir, ref + '^{tree}')
+        if tree and tree[1] == 'tree':
+            trees[(repo, ref)] = tree[0]
+    return trees
+
+
+def _tree_from_server(pair):
+    repo, ref = pair
+    url = (app.settings['cache-server'] + 'repo=' + get_repo_url(repo) +
+           '&ref=' + ref)
+    try:
+        response = urlopen(url, timeout=30)
+        return json.loads(response.read().decode())['tree']
+    except:
+        return None
+
+
+def cached_trees():
+    '''Return {(repo, ref): tree} for the trees kept by get_trees().'''
+    trees = {}
+    for key, tree in _load_tree_memo().items():
+        repo, ref = key.rsplit(' ', 1)
+        trees[(repo, ref)] = tree
+    return trees
+
+
+def _tree_memo_file():
+    return os.path.join(app.settings['caches'], 'trees.json')
+
+
+def _load_tree_memo():
+    try:
+        with open(_tree_memo_file()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_tree_memo(memo):
+    tmpfile = '%s.%s' % (_tree_memo_file(), app.settings['instance'])
+    with open(tmpfile, 'w') as f:
+        json.dump(memo, f)
+    os.rename(tmpfile, _tree_memo_file())
+
+
+def cat_file(gitdir, name):
+    '''Return (sha, type) of object `name` in gitdir, or None if missing.
 
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-        if call(['git', 'rev-parse', ref + '^{object}'], stdout=fnull,
-                stderr=fnull):
-            # can't resolve this ref. is it upstream?
-            app.log(this, 'Fetching from upstream to resolve %s' % ref)
-            call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull)
+    `name` is anything git rev-parse understands, eg 'ref^{tree}'. Rather
+    than running git for every lookup, each process keeps a long-lived
+    `git cat-file --batch-check` for each of the last few repos it looked
+    in, and feeds it one query at a time.
 
+    '''
+    while True:
+        git, lock = _get_cat_file(gitdir)
+        if git is None:
+            return None
+        with lock:
+            if git.stdin.closed:
+                # evicted by another thread since we got it, try again
+                continue
+            try:
+                git.stdin.write(name + '\n')
+                git.stdin.flush()
+                fields = git.stdout.readline().split()
+            except (IOError, OSError, ValueError):
+                fields = []
+        if not fields:
+            # git has gone away; start another one next time
+            _close_cat_file(gitdir, git)
+        if len(fields) == 3:
+            return fields[0], fields[1]
+        return None
+
+
+def _get_cat_file(gitdir):
+    key = (os.getpid(), gitdir)
+    evicted = []
+    with _cat_files_lock:
+        if key in _cat_files:
+            _cat_files[key] = _cat_files.pop(key)
+        else:
+            if not os.path.isdir(gitdir):
+                return None, None
+            while len(_cat_files) >= _cat_files_max:
+                evicted.append(_cat_files.popitem(last=False)[1])
+            git = Popen(['git', 'cat-file', '--batch-check'], cwd=gitdir,
+                        stdin=PIPE, stdout=PIPE, universal_newlines=True)
+            _cat_files[key] = (git, threading.Lock())
+        entry = _cat_files[key]
+    for git, lock in evicted:
+        _stop_cat_file(git, lock)
+    return entry
+
+
+def _close_cat_file(gitdir, git=None):
+    '''Stop our cat-file for gitdir, eg because its refs have changed.
+
+    If `git` is given, we only stop it if it is still the one for gitdir.
+
+    '''
+    key = (os.getpid(), gitdir)
+    with _cat_files_lock:
+        entry = _cat_files.get(key)
+        if entry is None or git not in (None, entry[0]):
+            return
+        del _cat_files[key]
+    _stop_cat_file(*entry)
+
+
+def close_cat_files():
+    '''Stop all of our cat-files, eg at the end of a batch of lookups.'''
+    with _cat_files_lock:
+        entries = [_cat_files.pop(key) for key in list(_cat_files)
+                   if key[0] == os.getpid()]
+    for git, lock in entries:
+        _stop_cat_file(git, lock)
+
+
+def _stop_cat_file(git, lock):
+    # wait for whoever is using it to finish their query
+    with lock:
+        try:
+            git.stdin.close()
+        except (IOError, OSError):
+            pass
+        git.stdout.close()
+        # a forked child, eg an upload, may still have the other end of
+        # stdin open, so git won't see EOF and we have to stop it
         try:
-            tree = check_output(['git', 'rev-parse', ref + '^{tree}'],
-                                universal_newlines=True)[0:-1]
-            return tree
+            git.terminate()
+        except OSError:
+            pass
+        git.wait()
 
-        except:
-            # either we don't have a git dir, or ref is not unique
-            # or ref does not exist
 
-            app.exit(this, 'ERROR: could not find tree for ref', (ref, gitdir))
+def get_mirror(name, repo, ref, wait=True):
+    '''Make sure there is a mirror of repo which has ref, return its path.
+
+    This holds a lock on the mirror while it works, so it is safe to call
+    for the same repo from several threads or instances at once. If `wait`
+    is False and someone else has the lock, we return None straight away.
+
+    '''
+    gitdir = os.path.join(app.settings['gits'], get_repo_name(repo))
+    with open(gitdir + '.lock', 'w') as lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | (0 if wait else
+                                                   fcntl.LOCK_NB))
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        if not os.path.exists(gitdir):
+            mirror(name, repo)
+        elif not mirror_has_ref(gitdir, ref):
+            update_mirror(name, repo, gitdir)
+    return gitdir
 
 
 def mirror(name, repo):
@@ -124,58 +359,335 @@ def mirror(name, repo):
         tar_file = get_repo_name(repo_url) + '.tar'
         app.log(name, 'Try fetching tarball %s' % tar_file)
         # try tarball first
-        with app.chdir(tmpdir), open(os.devnull, "w") as fnull:
-            call(['wget', os.path.join(app.settings['tar-url'], tar_file)])
-            call(['tar', 'xf', tar_file], stdout=fnull, stderr=fnull)
-            os.remove(tar_file)
+        if not seed_from_tarball(name, os.path.join(app.settings['tar-url'],
+                                                    tar_file),
+                                 tmpdir, gitdir + '.tar.part'):
+            raise BaseException('Did not get a tarball')
+        with open(os.devnull, "w") as fnull:
             call(['git', 'config', 'remote.origin.url', repo_url],
-                 stdout=fnull, stderr=fnull)
+                 stdout=fnull, stderr=fnull, cwd=tmpdir)
             call(['git', 'config', 'remote.origin.mirror', 'true'],
-                 stdout=fnull, stderr=fnull)
+                 stdout=fnull, stderr=fnull, cwd=tmpdir)
             if call(['git', 'config', 'remote.origin.fetch',
                      '+refs/*:refs/*'],
-                    stdout=fnull, stderr=fnull) != 0:
+                    stdout=fnull, stderr=fnull, cwd=tmpdir) != 0:
                 raise BaseException('Did not get a valid git repo')
-            call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull)
+            call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull,
+                 cwd=tmpdir)
     except:
         app.log(name, 'Try git clone from', repo_url)
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
         with open(os.devnull, "w") as fnull:
             if call(['git', 'clone', '--mirror', '-n', repo_url, tmpdir]):
                 app.exit(name, 'ERROR: failed to clone', repo)
 
-    with app.chdir(tmpdir):
-        if call(['git', 'rev-parse']):
-            app.exit(name, 'ERROR: problem mirroring git repo at', tmpdir)
+    if call(['git', 'rev-parse'], cwd=tmpdir):
+        app.exit(name, 'ERROR: problem mirroring git repo at', tmpdir)
 
     os.rename(tmpdir, gitdir)
     app.log(name, 'Git repo is mirrored at', gitdir)
 
 
+def seed_from_tarball(name, url, tmpdir, part):
+    '''Extract the tarball at url into tmpdir, return True if it worked.
+
+    The download is piped into tar as it arrives, and also appended to
+    `part`. If the connection drops, or an earlier run was interrupted,
+    what we already have is replayed from `part` and only the rest is
+    asked for, with a Range header. If-Range makes sure the tarball hasn't
+    changed on the server in the meantime. The result has to match the
+    server's Content-Length and tar has to succeed.
+
+    '''
+    for attempt in range(3):
+        result = _download_into_tar(name, url, tmpdir, part)
+        if result is not None:
+            break
+        # try again, resuming from whatever is in part
+        shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+
+    # if we get killed before here, part is kept for next time
+    for filename in [part, part + '.meta']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    return bool(result)
+
+
+def _download_into_tar(name, url, tmpdir, part):
+    '''Do one attempt at seed_from_tarball().
+
+    Returns True or False if we're done, or None to try again.
+
+    '''
+    meta = {}
+    try:
+        with open(part + '.meta') as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        pass
+    if meta.get('url') != url or not os.path.exists(part):
+        meta = {'url': url}
+        open(part, 'w').close()
+
+    with open(os.devnull, "w") as fnull:
+        tar = Popen(['tar', 'x'], stdin=PIPE, stdout=fnull, stderr=fnull,
+                    cwd=tmpdir)
+    received = 0
+    try:
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                tar.stdin.write(chunk)
+                received += len(chunk)
+
+        request = Request(url)
+        if received:
+            app.log(name, 'Resuming tarball download at %s bytes' % received)
+            request.add_header('Range', 'bytes=%s-' % received)
+            if meta.get('validator'):
+                request.add_header('If-Range', meta['validator'])
+        with _server_slot(url):
+            try:
+                response = urlopen(request, timeout=60)
+            except HTTPError as e:
+                if e.code == 416:
+                    # what we have doesn't fit any more, start again
+                    open(part, 'w').close()
+                    return None
+                return False
+            except Exception:
+                return False
+
+            if received and response.getcode() != 206:
+                # the server is sending all of it, so start again
+                open(part, 'w').close()
+                return None
+
+            length = response.info().get('Content-Length')
+            total = received + int(length) if length else None
+            meta['validator'] = (response.info().get('ETag') or
+                                 response.info().get('Last-Modified'))
+            with open(part + '.meta', 'w') as f:
+                json.dump(meta, f)
+
+            with open(part, 'ab') as f:
+                while True:
+                    try:
+                        chunk = response.read(1024 * 1024)
+                    except Exception:
+                        app.log(name, 'WARNING: tarball download '
+                                'interrupted at', received)
+                        return None
+                    if not chunk:
+                        break
+                    tar.stdin.write(chunk)
+                    f.write(chunk)
+                    received += len(chunk)
+
+        if total is not None and received != total:
+            app.log(name, 'WARNING: tarball is short, got', received)
+            return None
+        tar.stdin.close()
+        if tar.wait() != 0:
+            app.log(name, 'WARNING: tarball did not extract from', url)
+            return False
+        return True
+    except (IOError, OSError) as e:
+        if e.errno != errno.EPIPE:
+            raise
+        app.log(name, 'WARNING: tarball did not extract from', url)
+        return False
+    finally:
+        if tar.poll() is None:
+            tar.stdin.close()
+            tar.kill()
+            tar.wait()
+
+
+def _server_slot(url):
+    '''Return a semaphore limiting downloads from url's server.
+
+    No more than 'prefetch-per-host' downloads from the same server run at
+    once, across all threads in this process.
+
+    '''
+    host = urlparse(url).netloc or 'localhost'
+    with _servers_lock:
+        if host not in _servers:
+            _servers[host] = threading.Semaphore(
+                app.settings.get('prefetch-per-host', 4))
+        return _servers[host]
+
+
 def fetch(repo):
-    with app.chdir(repo), open(os.devnull, "w") as fnull:
-        call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull)
+    with open(os.devnull, "w") as fnull:
+        call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull, cwd=repo)
+    _close_cat_file(repo)
 
 
 def mirror_has_ref(gitdir, ref):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-        out = call(['git', 'cat-file', '-t', ref], stdout=fnull, stderr=fnull)
-        return out == 0
+    return cat_file(gitdir, ref) is not None
 
 
 def update_mirror(name, repo, gitdir):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
+    with open(os.devnull, "w") as fnull:
         app.log(name, 'Refreshing mirror for %s' % repo)
         if call(['git', 'remote', 'update', 'origin'], stdout=fnull,
-                stderr=fnull):
+                stderr=fnull, cwd=gitdir):
             app.exit(name, 'ERROR: git update mirror failed', repo)
+    _close_cat_file(gitdir)
+
+
+def prefetch(components):
+    '''Start mirroring the repos of components in the background.
+
+    Components whose mirror is missing or doesn't have their ref are fetched
+    by a forked child, so that builds can start while it works. The child
+    runs 'prefetch-threads' fetches at once, but no more than
+    'prefetch-per-host' from any one server. checkout() waits for the lock
+    on any mirror which is still being fetched, and the child skips any
+    mirror which is already locked, because a build is fetching it.
+
+    wait_for_prefetch() waits for the child to finish. If we exit without
+    doing that, the child and its gits are stopped. Returns the child's
+    pid, or None if there was nothing to fetch.
+
+    '''
+    todo = {}
+    for component in components:
+        if not component.get('repo'):
+            continue
+        gitdir = os.path.join(app.settings['gits'],
+                              get_repo_name(component['repo']))
+        if os.path.exists(gitdir) and \
+                mirror_has_ref(gitdir, component['ref']):
+            continue
+        todo.setdefault(gitdir, component)
+    close_cat_files()
+    if not todo:
+        return None
+
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid:
+        # the child leads a process group with its gits, see _stop_prefetch
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        _prefetches.append(pid)
+        atexit.register(_stop_prefetch, os.getpid(), pid)
+        return pid
+
+    os.setpgid(0, 0)
+    app.settings['pid'] = os.getpid()
+    hosts = {}
+    for component in todo.values():
+        host = urlparse(get_repo_url(component['repo'])).netloc or 'localhost'
+        if host not in hosts:
+            hosts[host] = threading.Semaphore(
+                app.settings.get('prefetch-per-host', 4))
+    progress = {'done': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def _prefetch(component):
+        host = urlparse(get_repo_url(component['repo'])).netloc or 'localhost'
+        with hosts[host]:
+            try:
+                gitdir = get_mirror(component['name'], component['repo'],
+                                    component['ref'], wait=False)
+                failed = False
+            except BaseException:
+                gitdir, failed = None, True
+        with lock:
+            progress['done'] += 1
+            if failed:
+                progress['failed'] += 1
+                app.log(component, 'WARNING: prefetch failed for',
+                        component['repo'])
+            elif gitdir is None:
+                app.log(component, 'Skipping prefetch, mirror is locked')
+            app.log('PREFETCH', 'Fetched %s of %s repos' %
+                    (progress['done'], len(todo)))
+
+    status = 0
+    try:
+        app.log('PREFETCH', 'Fetching %s repos from %s hosts' %
+                (len(todo), len(hosts)))
+        pool = ThreadPool(app.settings.get('prefetch-threads', 8))
+        try:
+            pool.map(_prefetch, sorted(todo.values(),
+                                       key=lambda c: c['name']))
+        finally:
+            pool.close()
+            pool.join()
+        pool.join()
+        if progress['failed']:
+            status = 1
+    except BaseException:
+        status = 1
+    sys.stdout.flush()
+    os._exit(status)
+
+
+def wait_for_prefetch():
+    '''Wait for any prefetch we started to finish.'''
+    while _prefetches:
+        try:
+            os.waitpid(_prefetches.pop(), 0)
+        except OSError:
+            # the scheduler's waitpid(-1) got it first
+            pass
+
+
+def _stop_prefetch(parent, pid):
+    '''Stop a prefetch which is still running when we exit.
+
+    On the normal path wait_for_prefetch() has already reaped it, so this
+    is for when we exit early, eg because a build failed, when we don't
+    want to wait for the rest of the mirrors to be fetched.
+
+    '''
+    # forked builds inherit atexit handlers, but this is for the parent
+    if os.getpid() != parent or pid not in _prefetches:
+        return
+    _prefetches.remove(pid)
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except OSError:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    try:
+        os.waitpid(pid, 0)
+    except OSError:
+        pass
 
 
 def checkout(name, repo, ref, checkout):
-    gitdir = os.path.join(app.settings['gits'], get_repo_name(repo))
-    if not os.path.exists(gitdir):
-        mirror(name, repo)
-    elif not mirror_has_ref(gitdir, ref):
-        update_mirror(name, repo, gitdir)
+    normalised = _checkout(name, repo, ref, checkout)
+    utils.set_mtime_recursively(checkout, skip=normalised)
+
+
+def _checkout(name, repo, ref, checkout):
+    gitdir = get_mirror(name, repo, ref)
+    if app.settings.get('checkout') == 'export':
+        export(name, gitdir, ref, checkout)
+        version = get_version(gitdir, ref)
+    else:
+        clone(name, gitdir, ref, checkout)
+        version = get_version(checkout, ref)
+    app.log(name, 'Git checkout %s in %s' % (repo, checkout))
+    app.log(name, 'Upstream version %s' % version)
+
+    if os.path.exists(os.path.join(checkout, '.gitmodules')):
+        return checkout_submodules(name, gitdir, ref, checkout)
+    return []
+
+
+def clone(name, gitdir, ref, checkout):
     # checkout the required version of this from git
     with open(os.devnull, "w") as fnull:
         # We need to pass '--no-hardlinks' because right now there's nothing to
@@ -187,55 +699,121 @@ def checkout(name, repo, ref, checkout):
                 stdout=fnull, stderr=fnull):
             app.exit(name, 'ERROR: git clone failed for', ref)
 
-        with app.chdir(checkout):
-            if call(['git', 'checkout', '--force', ref], stdout=fnull,
-                    stderr=fnull):
-                app.exit(name, 'ERROR: git checkout failed for', ref)
+        if call(['git', 'checkout', '--force', ref], stdout=fnull,
+                stderr=fnull, cwd=checkout):
+            app.exit(name, 'ERROR: git checkout failed for', ref)
 
-            app.log(name, 'Git checkout %s in %s' % (repo, checkout))
-            app.log(name, 'Upstream version %s' % get_version(checkout, ref))
 
-            if os.path.exists('.gitmodules'):
-                checkout_submodules(name, ref)
+def export(name, gitdir, ref, checkout):
+    '''Write the files at ref in gitdir to checkout, without any history.
+
+    The tree is read into a throwaway index and written out from there, so
+    nothing is copied from the mirror except the files themselves, and the
+    build can't get at the mirror. The checkout has no .git, so components
+    whose builds need git history should stick to the default 'clone'.
+
+    '''
+    tmpdir = tempfile.mkdtemp(dir=app.settings['tmp'])
+    env = dict(os.environ)
+    env['GIT_INDEX_FILE'] = os.path.join(tmpdir, 'index')
+    try:
+        with open(os.devnull, "w") as fnull:
+            if call(['git', '--git-dir', gitdir, 'read-tree', ref], env=env,
+                    stdout=fnull, stderr=fnull):
+                app.exit(name, 'ERROR: git read-tree failed for', ref)
+            if not os.path.isdir(checkout):
+                os.makedirs(checkout)
+            if call(['git', '--git-dir', gitdir, '--work-tree', checkout,
+                     'checkout-index', '--all', '--force'], env=env,
+                    stdout=fnull, stderr=fnull):
+                app.exit(name, 'ERROR: git checkout-index failed for', ref)
+    finally:
+        shutil.rmtree(tmpdir)
 
-    utils.set_mtime_recursively(checkout)
 
+def checkout_submodules(name, gitdir, ref, checkout):
+    '''Check out the submodules of the checkout of ref in gitdir.
 
-def checkout_submodules(name, ref):
+    The commits for all of the submodules are looked up with one ls-tree,
+    and the submodules are then mirrored and checked out in parallel. If
+    the source cache is on, each submodule comes from a snapshot of its
+    tree, so a submodule shared by several chunks is only checked out once.
+
+    Returns the directories which came from snapshots, whose mtimes are
+    already normalised.
+
+    '''
     app.log(name, 'Git submodules')
-    with open('.gitmodules', "r") as gitfile:
+    with open(os.path.join(checkout, '.gitmodules'), "r") as gitfile:
         # drop indentation in sections, as RawConfigParser cannot handle it
         content = '\n'.join([l.strip() for l in gitfile.read().splitlines()])
     io = StringIO(content)
     parser = RawConfigParser()
     parser.readfp(io)
 
+    submodules = []
     for section in parser.sections():
         # validate section name against the 'submodule "foo"' pattern
         submodule = re.sub(r'submodule "(.*)"', r'\1', section)
         url = parser.get(section, 'url')
         path = parser.get(section, 'path')
+        submodules.append((url, path))
 
+    try:
+        # list objects in the parent repo tree to find the commit
+        # objects that correspond to the submodules
+        entries = {}
+        output = check_output(['git', '--git-dir', gitdir, 'ls-tree', '-z',
+                               ref, '--'] + [path for url, path in submodules],
+                              universal_newlines=True)
+        for entry in output.split('\0'):
+            if entry:
+                fields, path = entry.split('\t', 1)
+                entries[path] = fields.split()
+    except:
+        app.exit(name, "ERROR: git submodules problem")
+
+    todo = []
+    for url, path in submodules:
+        fields = entries.get(path, [])
+        # fail if the commit hash is invalid
+        if len(fields) >= 2 and fields[1] == 'commit':
+            if len(fields[2]) != 40:
+                app.exit(name, "ERROR: git submodules problem")
+            todo.append((url, fields[2], os.path.join(checkout, path)))
+        else:
+            app.log(name, 'Skipping submodule %s, not a commit:' % path,
+                    fields)
+
+    def _checkout_submodule(submodule):
+        url, commit, fulldir = submodule
         try:
-            # list objects in the parent repo tree to find the commit
-            # object that corresponds to the submodule
-            commit = check_output(['git', 'ls-tree', ref, path])
-
-            # read the commit hash from the output
-            fields = commit.split()
-            if len(fields) >= 2 and fields[1] == 'commit':
-                submodule_commit = commit.split()[2]
-
-                # fail if the commit hash is invalid
-                if len(submodule_commit) != 40:
-                    raise Exception
-
-                fulldir = os.path.join(os.getcwd(), path)
-                checkout(name, url, submodule_commit, fulldir)
-
-            else:
-                app.log(name, 'Skipping submodule %s, not a commit:' % path,
-                        fields)
-
-        except:
-            app.exit(name, "ERROR: git submodules problem")
+            if app.settings.get('source-cache-gb'):
+                subgitdir = get_mirror(name, url, commit)
+                tree = cat_file(subgitdir, commit + '^{tree}')[0]
+                this = {'name': fulldir, 'repo': url, 'ref': commit,
+                        'tree': tree}
+                sourcedir = cache.unpack_source(this, this)
+                if not utils.cp(sourcedir + '/.', fulldir, '--reflink=auto'):
+                    utils.copy_all_files(sourcedir, fulldir)
+                cache.release_unpacked(this)
+                return [fulldir]
+            return _checkout(name, url, commit, fulldir)
+        except BaseException as e:
+            return e
+
+    normalised = []
+    if todo:
+        pool = ThreadPool(min(len(todo), 8))
+        try:
+            results = pool.map(_checkout_submodule, todo)
+        finally:
+            pool.close()
+            pool.join()
+        pool.join()
+        errors = [e for e in results if isinstance(e, BaseException)]
+        if errors:
+            app.exit(name, "ERROR: git submodules problem", errors[0])
+        for result in results:
+            normalised.extend(result)
+    return normalised
@@ -34,6 +34,9 @@ from repos import get_repo_url
 # can be used.
 executor = None
 
+# staging methods which this host supports, see staging_method()
+_capabilities = {}
+
 
 def builddir_for_component(this):
     return this['name'] + '.build'
@@ -69,41 +72,157 @@ def setup(this):
 
 
 def remove(this):
+    if os.path.ismount(this['sandbox']):
+        call(['umount', this['sandbox']])
+        for directory in ['.upper', '.work']:
+            shutil.rmtree(this['sandbox'] + directory)
     if this['sandbox'] != '/' and os.path.isdir(this['sandbox']):
         shutil.rmtree(this['sandbox'])
         app.log(this, 'Cleaned up', this['sandbox'])
+    this.pop('installed', None)
+    cache.release_unpacked(this)
 
 
 def install(defs, this, component):
-    if os.path.exists(os.path.join(this['sandbox'], 'baserock',
-                                   component['name'] + '.meta')):
+    installed = this.setdefault('installed', set())
+    if component['path'] in installed:
         return
 
     app.log(this, 'Installing %s' % component['cache'])
-    _install(defs, this, component)
+    for path in defs.install_order(component):
+        if path not in installed:
+            installed.add(path)
+            _install(defs, this, defs.get(path))
 
 
 def _install(defs, this, component):
-    if os.path.exists(os.path.join(this['sandbox'], 'baserock',
-                                   component['name'] + '.meta')):
-        return
+    unpackdir = cache.unpack(defs, component, this)
+    method = staging_method(this)
+    if method == 'overlay':
+        # stage() mounts these over the sandbox once everything is in
+        this.setdefault('lowerdirs', []).append(unpackdir)
+    else:
+        _stage_tree(this, unpackdir, method)
+
+
+def staging_method(this):
+    '''Return how to put artifacts into this's sandbox.
+
+    The 'staging' setting in ybd.def picks one of
+
+    - overlay: mount the unpacked artifacts as overlayfs lowerdirs
+    - reflink: copy with cp --reflink, sharing blocks on btrfs/xfs
+    - cp: hardlink (or for systems, copy) with cp -a
+    - python: utils.hardlink_all_files() and utils.copy_all_files()
+
+    overlay and reflink are only used if this host can do them. Note that
+    with overlay, an artifact's directory hides a symlink of the same name
+    from earlier artifacts instead of being merged into its target, so it
+    is only picked if asked for.
+
+    The default, 'auto', is cp, except for systems where we use reflink if
+    the filesystem supports it, because systems need copies.
+
+    '''
+    method = app.settings.get('staging', 'auto')
+    if method in ['overlay', 'reflink'] and not _can_stage_with(method):
+        method = 'auto'
+    if method == 'auto':
+        if this.get('kind') == 'system' and _can_stage_with('reflink'):
+            return 'reflink'
+        return 'cp'
+    return method
+
+
+def _can_stage_with(method):
+    if method not in _capabilities:
+        if method == 'overlay':
+            with open('/proc/filesystems') as f:
+                _capabilities[method] = (os.geteuid() == 0 and
+                                         'overlay' in f.read().split())
+        elif method == 'reflink':
+            # try reflinking a file from artifacts to tmp
+            src = tempfile.NamedTemporaryFile(dir=app.settings['artifacts'])
+            dest = tempfile.mkdtemp(dir=app.settings['tmp'])
+            _capabilities[method] = utils.cp(src.name, dest,
+                                             '--reflink=always')
+            src.close()
+            shutil.rmtree(dest)
+    return _capabilities[method]
+
+
+def _stage_tree(this, unpackdir, method):
+    if this.get('kind') == 'system':
+        options = ['--reflink=always'] if method == 'reflink' else []
+        if method == 'python' or not utils.cp(unpackdir + '/.',
+                                              this['sandbox'], *options):
+            counters = utils.copy_all_files(unpackdir, this['sandbox'])
+            _log_staged(this, 'Copied', counters,
+                        os.path.basename(unpackdir))
+    else:
+        options = ['--reflink=always'] if method == 'reflink' else ['-l']
+        if method == 'python' or not utils.cp(unpackdir + '/.',
+                                              this['sandbox'], *options):
+            counters = utils.hardlink_all_files(unpackdir, this['sandbox'])
+            _log_staged(this, 'Linked', counters,
+                        os.path.basename(unpackdir))
 
-    for it in component.get('build-depends', []):
-        dependency = defs.get(it)
-        if (dependency.get('build-mode', 'staging') ==
-                component.get('build-mode', 'staging')):
-            _install(defs, this, dependency)
 
-    for it in component.get('contents', []):
-        subcomponent = defs.get(it)
-        if subcomponent.get('build-mode', 'staging') != 'bootstrap':
-            _install(defs, this, subcomponent)
+def _log_staged(this, action, counters, source):
+    '''Log the counters from utils.copy_all_files() or hardlink_all_files().'''
+    app.log(this, '%s %s files, %s bytes in %s dirs, saved %s syscalls' %
+            (action, counters['files'], counters['bytes'], counters['dirs'],
+             counters['syscalls-saved']), 'from %s' % source)
 
-    unpackdir = cache.unpack(defs, component)
-    if this.get('kind') is 'system':
-        utils.copy_all_files(unpackdir, this['sandbox'])
-    else:
-        utils.hardlink_all_files(unpackdir, this['sandbox'])
+
+def stage_source(this):
+    '''Copy this's source from the snapshot cache into its build dir.
+
+    Builds write into their source trees, so the snapshot is copied rather
+    than hardlinked, with reflinks if the filesystem supports them.
+
+    '''
+    sourcedir = cache.unpack_source(this, this)
+    options = [['--reflink=always']] if _can_stage_with('reflink') else []
+    for option in options + [[]]:
+        if utils.cp(sourcedir + '/.', this['build'], *option):
+            return
+    counters = utils.copy_all_files(sourcedir, this['build'])
+    _log_staged(this, 'Copied', counters, sourcedir)
+
+
+def stage(this):
+    '''Mount the artifacts queued by _install() as an overlay on the sandbox.
+
+    The sandbox so far (build and install dirs, /dev, /tmp) becomes the
+    writable upper layer. If the mount fails, for example because there are
+    too many layers for the mount options, we fall back to cp.
+
+    '''
+    lowerdirs = this.pop('lowerdirs', [])
+    if not lowerdirs:
+        return
+
+    sandbox = this['sandbox']
+    os.rename(sandbox, sandbox + '.upper')
+    os.mkdir(sandbox)
+    os.mkdir(sandbox + '.work')
+    # the last artifact installed wins, so it goes on top
+    options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+        ':'.join(reversed(lowerdirs)), sandbox + '.upper', sandbox + '.work')
+    with open(os.devnull, "w") as fnull:
+        if call(['mount', '-t', 'overlay', 'overlay', '-o', options,
+                 sandbox], stdout=fnull, stderr=fnull) == 0:
+            app.log(this, 'Mounted %s artifacts as overlay on' %
+                    len(lowerdirs), sandbox)
+            return
+
+    app.log(this, 'WARNING: overlay mount failed, staging with cp instead')
+    os.rmdir(sandbox)
+    os.rmdir(sandbox + '.work')
+    os.rename(sandbox + '.upper', sandbox)
+    for unpackdir in lowerdirs:
+        _stage_tree(this, unpackdir, 'cp')
 
 
 def ldconfig(this):
@@ -0,0 +1,374 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import datetime
+import os
+import re
+import sys
+import time
+
+import app
+import assembly
+import cache
+
+# {name: seconds} from the build-times file, see build_times()
+_build_times = None
+
+# {name: [paths]} of build-logs in 'artifacts', see build_time()
+_build_logs = None
+
+
+def dependencies(defs, component):
+    '''Return the paths which must be assembled before `component`.
+
+    This is everything it depends on, less bootstrap chunks in its contents,
+    which assemble() doesn't build as part of it.
+
+    '''
+    contents = set(component.get('contents', []))
+    return [it for it in defs.dependencies(component) if it not in contents
+            or defs.get(it).get('build-mode') != 'bootstrap']
+
+
+def build_graph(defs, target):
+    '''Return {path: set(paths)} of everything target needs built.
+
+    Each value is the set of not-yet-cached paths that the key depends on.
+    Components which are already cached, or which are for another arch,
+    are left out along with everything below them, just as the recursive
+    assemble() would skip them.
+
+    '''
+    graph = {}
+    todo = [defs.get(target)['path']]
+    while todo:
+        path = todo.pop()
+        if path in graph:
+            continue
+        component = defs.get(path)
+        if cache.get_cache(defs, component):
+            continue
+        if component.get('arch') and \
+                component['arch'] != app.settings['arch']:
+            continue
+        graph[path] = set(dependencies(defs, component))
+        todo.extend(graph[path])
+
+    for path in graph:
+        graph[path] = set(p for p in graph[path] if p in graph)
+
+    return graph
+
+
+def assemble(defs, target):
+    '''Assemble target, running up to 'build-workers' builds at once.
+
+    Each build runs in a forked child which calls assembly.assemble() once
+    all of its dependencies are cached, so the child never recurses. The
+    parent just tracks which components are ready and what is running.
+
+    Before starting a build the parent claims it (see cache.claim), and
+    releases the claim when the child exits. If another instance has the
+    claim, we get on with other ready work and pick up the artifact when
+    it appears.
+
+    '''
+    graph = build_graph(defs, target)
+    priority = _priorities(defs, target, graph)
+    workers = app.settings['build-workers']
+    max_jobs = app.settings['max-jobs']
+    running = {}
+    # {pid: max-jobs} of the running builds
+    jobs = {}
+    elsewhere = set()
+    failed = []
+
+    with app.timer(target, 'Building %s components with %s workers' %
+                   (len(graph), workers)):
+        while graph or running:
+            for path in list(elsewhere):
+                if cache.get_cache(defs, path):
+                    app.log(path, 'Built by another instance')
+                    elsewhere.discard(path)
+                    _done(defs, graph, path)
+
+            # start whatever heads the longest chain of work still to do
+            ready = [p for p in sorted(graph, key=lambda p: -priority[p])
+                     if not graph[p] and p not in running.values()]
+            # split max-jobs across the builds we expect to be running,
+            # so that a pool of workers doesn't oversubscribe the machine.
+            # Builds keep the jobs they started with, so new ones only get
+            # what is left over, and wait if there is nothing left.
+            active = min(workers, len(running) + len(ready)) or 1
+            share = max(max_jobs // active, 1)
+            while ready and not failed and len(running) < workers:
+                free = max_jobs - sum(jobs.values())
+                if running and free < 1:
+                    break
+                path = ready.pop(0)
+                if cache.claim(defs, path):
+                    elsewhere.discard(path)
+                    pid = _start(defs, path, min(share, free))
+                    running[pid] = path
+                    jobs[pid] = min(share, free)
+                elif path not in elsewhere:
+                    app.log(path, 'Being built by another instance')
+                    elsewhere.add(path)
+
+            if not running:
+                if failed:
+                    break
+                if not elsewhere:
+                    app.exit(target, 'ERROR: nothing left that can be built',
+                             sorted(graph))
+                time.sleep(5)
+                continue
+
+            pid, status = os.waitpid(-1, os.WNOHANG if elsewhere else 0)
+            if pid == 0:
+                time.sleep(5)
+                continue
+            path = running.pop(pid, None)
+            jobs.pop(pid, None)
+            if path is None:
+                continue
+            # the claim is ours, whatever the child did with it
+            cache.release(defs, path)
+            if status != 0 or not cache.get_cache(defs, path):
+                app.log(path, 'ERROR: build failed, waiting for', running)
+                failed.append(path)
+                continue
+            _done(defs, graph, path)
+
+    if failed:
+        app.exit(target, 'ERROR: failed to build', failed)
+
+    return cache.cache_key(defs, target)
+
+
+def _priorities(defs, target, graph):
+    '''Return {path: seconds from starting path to finishing target}.
+
+    This is the build time of path plus the longest chain of builds in the
+    graph which are waiting for it, using build times from previous runs.
+    Anything we have no time for is assumed to take the average.
+
+    '''
+    durations = dict((p, build_time(defs.get(p))) for p in graph)
+    known = [t for t in durations.values() if t is not None]
+    default = sum(known) // len(known) if known else 1
+
+    waiting = {}
+    for path, deps in graph.items():
+        for dep in deps:
+            waiting.setdefault(dep, []).append(path)
+
+    priority = {}
+    for path in reversed(defs.walk(target)):
+        if path in graph:
+            duration = durations[path]
+            priority[path] = (default if duration is None else duration) + \
+                max([priority[p] for p in waiting.get(path, [])] or [0])
+
+    if priority:
+        app.log(target, 'Longest chain is estimated at',
+                _hms(max(priority.values())))
+    return priority
+
+
+def _done(defs, graph, path):
+    del graph[path]
+    for dependent in defs.reverse_dependencies(path):
+        if dependent in graph:
+            graph[dependent].discard(path)
+
+
+def _start(defs, path, jobs):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    app.settings['pid'] = os.getpid()
+    app.settings['max-jobs'] = jobs
+    status = 0
+    try:
+        assembly.assemble(defs, path)
+    except BaseException:
+        status = 1
+    sys.stdout.flush()
+    os._exit(status)
+
+
+def impact(defs, target, path, ref=None):
+    '''Report what would be rebuilt if `path` (or name) changed, and how long.
+
+    If `ref` is given, we work out the new cache keys as if `path` was at
+    that ref, and report everything in target whose key changes. Otherwise
+    we assume that `path` changes, and report everything above it.
+
+    Estimates come from the Elapsed_time of previous builds. The critical
+    path is the longest chain of rebuilds which have to happen one after
+    another, ie how long the update takes with enough build-workers.
+
+    '''
+    walk = defs.walk(target)
+    found = [p for p in walk if path in (p, defs.get(p)['name'])]
+    if not found:
+        app.exit(target, 'ERROR: target does not depend on', path)
+    component = defs.get(found[0])
+
+    cache.resolve_trees(defs, target)
+    cache.cache_key(defs, target)
+    before = dict((p, defs.get(p)['cache']) for p in walk)
+
+    if ref is None:
+        changed = set([component['path']])
+        for p in walk:
+            if changed.intersection(defs.dependencies(p)):
+                changed.add(p)
+    else:
+        component['ref'] = ref
+        component.pop('tree', None)
+        for p in walk:
+            defs.get(p).pop('cache', None)
+        cache.resolve_trees(defs, target)
+        cache.cache_key(defs, target)
+        changed = set(p for p in walk if defs.get(p)['cache'] != before[p])
+
+    durations = {}
+    unknown = []
+    for p in changed:
+        durations[p] = build_time(defs.get(p), before[p])
+        if durations[p] is None:
+            unknown.append(p)
+            durations[p] = 0
+
+    # longest chain of changed components, working up from the bottom
+    finish = {}
+    previous = {}
+    for p in walk:
+        if p in changed:
+            deps = [d for d in dependencies(defs, defs.get(p)) if d in changed]
+            previous[p] = max(deps, key=lambda d: finish[d]) if deps else None
+            finish[p] = durations[p] + (finish[previous[p]] if deps else 0)
+
+    critical = []
+    p = max(finish, key=lambda p: finish[p]) if finish else None
+    while p:
+        critical.insert(0, p)
+        p = previous[p]
+
+    app.log(path, 'Components to rebuild', len(changed))
+    app.log(path, 'Total build time', _hms(sum(durations.values())))
+    app.log(path, 'Critical path', _hms(finish[critical[-1]])
+            if critical else _hms(0))
+    for p in critical:
+        app.log(p, 'Critical path build time', _hms(durations[p]))
+    if unknown:
+        app.log(path, 'WARNING: no previous build time for', sorted(unknown))
+
+    return changed
+
+
+def build_time(component, key=None):
+    '''Return seconds it took to build component last time, if we know.
+
+    We look in the build-log for the cache key first, then in the history
+    kept by record_build_time(), then in the newest build-log for any key
+    of the same component.
+
+    '''
+    artifacts = app.settings['artifacts']
+    if key:
+        seconds = _elapsed_time(os.path.join(artifacts, key + '.build-log'))
+        if seconds is not None:
+            return seconds
+
+    safename = component['name'].replace('/', '-')
+    if safename in build_times():
+        return build_times()[safename]
+
+    global _build_logs
+    if _build_logs is None:
+        _build_logs = {}
+        for filename in os.listdir(artifacts):
+            match = re.match(r'^(.*)\.[0-9a-f]{64}\.build-log$', filename)
+            if match:
+                _build_logs.setdefault(match.group(1), []).append(
+                    os.path.join(artifacts, filename))
+
+    logs = sorted(_build_logs.get(safename, []), key=os.path.getmtime)
+    for log in reversed(logs):
+        seconds = _elapsed_time(log)
+        if seconds is not None:
+            return seconds
+    return None
+
+
+def _elapsed_time(log):
+    try:
+        with open(log) as f:
+            times = re.findall(r'^Elapsed_time: (\d+):(\d+):(\d+)$',
+                               f.read(), re.MULTILINE)
+    except IOError:
+        return None
+    if times:
+        hours, minutes, seconds = times[-1]
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    return None
+
+
+def build_times():
+    '''Return {name: seconds} for the last build of each component.
+
+    record_build_time() appends a line to 'caches'/build-times for every
+    build, so the file is read once and the last line for a name wins.
+
+    '''
+    global _build_times
+    if _build_times is None:
+        _build_times = {}
+        try:
+            with open(os.path.join(app.settings['caches'],
+                                   'build-times')) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1].isdigit():
+                        _build_times[fields[0]] = int(fields[1])
+        except IOError:
+            pass
+    return _build_times
+
+
+def record_build_time(this):
+    '''Append how long this took to build to 'caches'/build-times.'''
+    seconds = int((datetime.datetime.now() -
+                   this['start-time']).total_seconds())
+    safename = this['name'].replace('/', '-')
+    try:
+        # one short write in append mode, so concurrent builds don't mix
+        with open(os.path.join(app.settings['caches'], 'build-times'),
+                  'a') as f:
+            f.write('%s %s\n' % (safename, seconds))
+    except IOError:
+        app.log(this, 'WARNING: could not record build time')
+    build_times()[safename] = seconds
+
+
+def _hms(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%02d:%02d:%02d" % (hours, minutes, seconds)
@@ -0,0 +1,132 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Test repos.prefetch() against local file:// repos.
+
+Run with pytest, or directly with python.
+
+'''
+
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+import repos
+
+
+def git(directory, *args):
+    return subprocess.check_output(('git',) + args, cwd=directory,
+                                   universal_newlines=True).strip()
+
+
+def make_repos(tmpdir, count):
+    components = []
+    for i in range(count):
+        directory = os.path.join(tmpdir, 'src', 'r%s' % i)
+        os.makedirs(directory)
+        git(directory, 'init', '-q')
+        with open(os.path.join(directory, 'file'), 'w') as f:
+            f.write('%s\n' % i)
+        git(directory, 'add', 'file')
+        git(directory, '-c', 'user.name=ybd', '-c', 'user.email=ybd@localhost',
+            'commit', '-q', '-m', 'r%s' % i)
+        components.append({'name': 'r%s' % i,
+                           'repo': 'file://' + directory,
+                           'ref': git(directory, 'rev-parse', 'HEAD')})
+    return components
+
+
+def setup(tmpdir):
+    app.settings.update({'pid': os.getpid(),
+                         'instance': 'localhost:%s' % os.getpid(),
+                         'gits': os.path.join(tmpdir, 'gits'),
+                         'tmp': os.path.join(tmpdir, 'tmp'),
+                         'tar-url': 'http://127.0.0.1:1/',
+                         'prefetch-threads': 4, 'prefetch-per-host': 2})
+    os.makedirs(app.settings['gits'])
+    os.makedirs(app.settings['tmp'])
+
+
+def test_prefetch():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        setup(tmpdir)
+        components = make_repos(tmpdir, 6)
+
+        pid = repos.prefetch(components)
+        assert pid
+        repos.wait_for_prefetch()
+        assert pid not in repos._prefetches
+        for component in components:
+            gitdir = os.path.join(app.settings['gits'],
+                                  repos.get_repo_name(component['repo']))
+            assert repos.mirror_has_ref(gitdir, component['ref'])
+
+        # nothing left to fetch, so no child
+        assert repos.prefetch(components) is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prefetch_skips_locked_mirrors():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        setup(tmpdir)
+        components = make_repos(tmpdir, 2)
+        locked = os.path.join(app.settings['gits'],
+                              repos.get_repo_name(components[0]['repo']))
+
+        # as get_mirror() does while a build is fetching the repo
+        with open(locked + '.lock', 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            repos.prefetch(components)
+            repos.wait_for_prefetch()
+        assert not os.path.exists(locked)
+        assert os.path.exists(os.path.join(
+            app.settings['gits'], repos.get_repo_name(components[1]['repo'])))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prefetch_is_stopped_at_exit():
+    tmpdir = tempfile.mkdtemp()
+    get_mirror = repos.get_mirror
+    try:
+        setup(tmpdir)
+        components = make_repos(tmpdir, 2)
+
+        # a fetch which takes far longer than we are prepared to wait
+        repos.get_mirror = lambda *args, **kwargs: time.sleep(60)
+        pid = repos.prefetch(components)
+        start = time.time()
+        repos._stop_prefetch(os.getpid(), pid)
+        assert time.time() - start < 10
+        assert pid not in repos._prefetches
+    finally:
+        repos.get_mirror = get_mirror
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_prefetch()
+    test_prefetch_skips_locked_mirrors()
+    test_prefetch_is_stopped_at_exit()
@@ -0,0 +1,216 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Test repos.seed_from_tarball() and repos.mirror() against a local server.
+
+Run with pytest, or directly with python.
+
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+import repos
+
+
+class TarballHandler(BaseHTTPRequestHandler):
+    '''Serve the tarballs in `files`, as {path: (data, etag)}.
+
+    Ranges are honoured if If-Range matches the etag, and the first
+    response is cut off after `drop_after` bytes if that is set. Each
+    request is recorded in `requests` as (path, Range, If-Range).
+
+    '''
+    files = {}
+    drop_after = None
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('Range'),
+                              self.headers.get('If-Range')))
+        if self.path not in self.files:
+            self.send_error(404)
+            return
+        data, etag = self.files[self.path]
+
+        start = 0
+        ranged = self.headers.get('Range')
+        if ranged and self.headers.get('If-Range') in (None, etag):
+            start = int(ranged.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' %
+                             (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        end = len(data)
+        if self.drop_after is not None:
+            end = self.drop_after
+            TarballHandler.drop_after = None
+        self.wfile.write(data[start:end])
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def git(directory, *args):
+    return subprocess.check_output(('git',) + args, cwd=directory,
+                                   universal_newlines=True).strip()
+
+
+def make_tarball(tmpdir, name, contents):
+    '''Return the bytes of a tarball holding file `name` with `contents`.'''
+    path = os.path.join(tmpdir, name)
+    with open(path, 'w') as f:
+        f.write(contents * 10000)
+    with tarfile.open(path + '.tar', 'w') as tar:
+        tar.add(path, arcname=name)
+    with open(path + '.tar', 'rb') as f:
+        return f.read()
+
+
+def setup(tmpdir, files):
+    TarballHandler.files = files
+    TarballHandler.drop_after = None
+    TarballHandler.requests = []
+    server = HTTPServer(('127.0.0.1', 0), TarballHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    app.settings.update({'pid': os.getpid(),
+                         'instance': 'localhost:%s' % os.getpid(),
+                         'gits': os.path.join(tmpdir, 'gits'),
+                         'tmp': os.path.join(tmpdir, 'tmp'),
+                         'tar-url': 'http://127.0.0.1:%s/' %
+                         server.server_address[1]})
+    for directory in ['gits', 'tmp', 'out']:
+        os.makedirs(os.path.join(tmpdir, directory))
+    return server
+
+
+def seed(tmpdir, path):
+    part = os.path.join(tmpdir, 'gits', 'seed.tar.part')
+    result = repos.seed_from_tarball('seed', app.settings['tar-url'] + path,
+                                     os.path.join(tmpdir, 'out'), part)
+    assert not os.path.exists(part)
+    assert not os.path.exists(part + '.meta')
+    return result
+
+
+def extracted(tmpdir, name):
+    with open(os.path.join(tmpdir, 'out', name)) as f:
+        return f.read()
+
+
+def test_resume_after_dropped_connection():
+    tmpdir = tempfile.mkdtemp()
+    data = make_tarball(tmpdir, 'file', 'new\n')
+    server = setup(tmpdir, {'/seed.tar': (data, '"new"')})
+    try:
+        TarballHandler.drop_after = len(data) // 2
+        assert seed(tmpdir, 'seed.tar')
+        assert extracted(tmpdir, 'file') == 'new\n' * 10000
+        assert TarballHandler.requests == [
+            ('/seed.tar', None, None),
+            ('/seed.tar', 'bytes=%s-' % (len(data) // 2), '"new"')]
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+
+def test_changed_tarball_is_fetched_again():
+    tmpdir = tempfile.mkdtemp()
+    old = make_tarball(tmpdir, 'file', 'old\n')
+    data = make_tarball(tmpdir, 'file', 'new\n')
+    server = setup(tmpdir, {'/seed.tar': (data, '"new"')})
+    try:
+        # half of the old tarball, as left by an earlier run which died
+        part = os.path.join(tmpdir, 'gits', 'seed.tar.part')
+        with open(part, 'wb') as f:
+            f.write(old[:len(old) // 2])
+        with open(part + '.meta', 'w') as f:
+            f.write('{"url": "%sseed.tar", "validator": "\\"old\\""}' %
+                    app.settings['tar-url'])
+
+        assert seed(tmpdir, 'seed.tar')
+        assert extracted(tmpdir, 'file') == 'new\n' * 10000
+        assert TarballHandler.requests == [
+            ('/seed.tar', 'bytes=%s-' % (len(old) // 2), '"old"'),
+            ('/seed.tar', None, None)]
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+
+def test_corrupt_tarball_is_rejected():
+    tmpdir = tempfile.mkdtemp()
+    server = setup(tmpdir, {'/seed.tar': (b'not a tarball\n' * 1000,
+                                          '"bad"')})
+    try:
+        assert not seed(tmpdir, 'seed.tar')
+        assert not os.listdir(os.path.join(tmpdir, 'out'))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+
+def test_missing_tarball_falls_back_to_clone():
+    tmpdir = tempfile.mkdtemp()
+    server = setup(tmpdir, {})
+    try:
+        source = os.path.join(tmpdir, 'src')
+        os.makedirs(source)
+        git(source, 'init', '-q')
+        with open(os.path.join(source, 'file'), 'w') as f:
+            f.write('file\n')
+        git(source, 'add', 'file')
+        git(source, '-c', 'user.name=ybd', '-c', 'user.email=ybd@localhost',
+            'commit', '-q', '-m', 'file')
+        repo = 'file://' + source
+
+        repos.mirror('src', repo)
+        gitdir = os.path.join(app.settings['gits'], repos.get_repo_name(repo))
+        assert repos.mirror_has_ref(gitdir, git(source, 'rev-parse', 'HEAD'))
+        assert len(TarballHandler.requests) == 1
+        assert TarballHandler.requests[0][0].endswith('.tar')
+        repos.close_cat_files()
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_resume_after_dropped_connection()
+    test_changed_tarball_is_fetched_again()
+    test_corrupt_tarball_is_rejected()
+    test_missing_tarball_falls_back_to_clone()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Compare the memory used by definitions as dicts and as Definitions.
+
+Usage: bench-definitions-memory.py [DEFINITIONS_DIR [TARGET]]
+
+Without DEFINITIONS_DIR we generate a system of 40 strata of 49 chunks.
+The definitions are loaded with 'compact-definitions' off and on, each
+in a fresh process so that they don't share interned strings, and we
+report the memory they hold after loading and after working out every
+cache key, and the size they pickle to for the build workers. We exit
+with an error if the compact ones are no smaller.
+
+Memory is measured with tracemalloc where we have it (Python 3), and
+otherwise as the growth in peak RSS, which is much rougher.
+
+'''
+
+import gc
+import os
+import pickle
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+
+STRATA = 40
+CHUNKS = 49
+
+
+def make_definitions(directory):
+    os.makedirs(os.path.join(directory, 'systems'))
+    with open(os.path.join(directory, 'systems', 'system.morph'), 'w') as f:
+        f.write('name: system\nkind: system\narch: x86_64\nstrata:\n')
+        for stratum in range(STRATA):
+            f.write('- name: s%s\n  morph: strata/s%s.morph\n' %
+                    (stratum, stratum))
+
+    for stratum in range(STRATA):
+        name = 's%s' % stratum
+        os.makedirs(os.path.join(directory, 'strata', name))
+        with open(os.path.join(directory, 'strata', name + '.morph'),
+                  'w') as f:
+            f.write('name: %s\nkind: stratum\n' % name)
+            if stratum:
+                f.write('build-depends:\n- morph: strata/s%s.morph\n' %
+                        (stratum - 1))
+            f.write('chunks:\n')
+            for i in range(CHUNKS):
+                f.write('- name: %s-c%s\n  morph: strata/%s/c%s.morph\n'
+                        '  repo: upstream:%s/c%s\n  ref: %040x\n'
+                        '  unpetrify-ref: master\n'
+                        '  build-depends: [%s]\n' %
+                        (name, i, name, i, name, i, stratum * CHUNKS + i,
+                         '%s-c%s' % (name, i - 1) if i else ''))
+        for i in range(CHUNKS):
+            with open(os.path.join(directory, 'strata', name,
+                                   'c%s.morph' % i), 'w') as f:
+                f.write('name: %s-c%s\nkind: chunk\nbuild-system: autotools\n'
+                        'configure-commands:\n' % (name, i))
+                for j in range(10):
+                    f.write('- ./configure --prefix=/usr --enable-thing-%s '
+                            '--with-foo=%s\n' % (j, j))
+                f.write('install-commands:\n'
+                        '- make DESTDIR="$DESTDIR" install\n')
+
+
+def measure(compact, target):
+    '''Load the definitions in cwd, and print what they take.'''
+    # pid 0 keeps app.log() quiet
+    app.settings.update({'pid': 0, 'instance': 'bench:0', 'caches': '.',
+                         'arch': 'x86_64', 'target': target,
+                         'compact-definitions': compact})
+    import cache
+    from definitions import Definitions
+
+    # the first load fills .parsed, so the one we measure only unpickles
+    Definitions()
+    gc.collect()
+    try:
+        import tracemalloc
+        tracemalloc.start()
+        used = lambda: tracemalloc.get_traced_memory()[0]
+    except ImportError:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        used = lambda: (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss *
+                        1024 - base)
+
+    defs = Definitions()
+    gc.collect()
+    loaded = used()
+    for definition in defs._definitions.values():
+        if definition.get('repo'):
+            definition['tree'] = '%040x' % len(definition['name'])
+    cache.cache_key(defs, target)
+    gc.collect()
+    keyed = used()
+    pickled = len(pickle.dumps(defs._definitions, 2))
+    print('%-10s %5s definitions: %6.2fMB loaded, %6.2fMB with keys, '
+          '%6.2fMB pickled' % ('compact' if compact else 'dicts',
+                               len(defs._definitions), loaded / 1e6,
+                               keyed / 1e6, pickled / 1e6))
+
+
+def main():
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2] == 'compact', sys.argv[3])
+        return
+
+    tmpdir = None
+    if len(sys.argv) > 1:
+        directory = os.path.abspath(sys.argv[1])
+        target = sys.argv[2]
+    else:
+        tmpdir = directory = tempfile.mkdtemp()
+        make_definitions(directory)
+        target = 'systems/system.morph'
+    try:
+        loaded = {}
+        for mode in ['dicts', 'compact']:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--measure',
+                 mode, target], cwd=directory, universal_newlines=True)
+            sys.stdout.write(output)
+            loaded[mode] = float(output.split()[3][:-2])
+        print('compact definitions use %d%% of the memory' %
+              (100 * loaded['compact'] / loaded['dicts']))
+        if loaded['compact'] >= loaded['dicts']:
+            sys.exit('ERROR: compact definitions are no smaller')
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
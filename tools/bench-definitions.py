@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Compare serial and parallel parsing of definitions files.
+
+Usage: bench-definitions.py [DEFINITIONS_DIR]
+
+Without DEFINITIONS_DIR we generate a tree of about 2000 files, 40
+strata and their chunks. We time parsing every file in this process, and
+with a Pool as Definitions._load_all() does, to work out how many files
+it takes for the Pool to pay for itself on 2, 4 and 8 cpus. The median
+of several rounds is what definitions._parallel_parse_min should be. On
+a machine with more than one cpu we also time batches of increasing
+size both ways.
+
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Pool, cpu_count
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import definitions
+
+# 40 strata of 49 chunks, about the size of a big baserock definitions tree
+STRATA = 40
+CHUNKS = 49
+BATCHES = [10, 25, 50, 100, 200, 500, 1000, 2000]
+ROUNDS = 7
+
+
+def make_definitions(directory):
+    for stratum in range(STRATA):
+        name = 's%s' % stratum
+        os.makedirs(os.path.join(directory, 'strata', name))
+        with open(os.path.join(directory, 'strata', name + '.morph'),
+                  'w') as f:
+            f.write('name: %s\nkind: stratum\nchunks:\n' % name)
+            for i in range(CHUNKS):
+                # each chunk depends on the one before, so c0 has none
+                f.write('- name: c%s\n  morph: strata/%s/c%s.morph\n'
+                        '  repo: upstream:%s/c%s\n  ref: %040x\n'
+                        '  build-depends: [%s]\n' %
+                        (i, name, i, name, i, i, 'c%s' % (i - 1) if i else ''))
+        for i in range(CHUNKS):
+            with open(os.path.join(directory, 'strata', name,
+                                   'c%s.morph' % i), 'w') as f:
+                f.write('name: c%s\nkind: chunk\nbuild-system: autotools\n'
+                        'configure-commands:\n' % i)
+                for j in range(10):
+                    f.write('- ./configure --prefix=/usr --enable-thing-%s '
+                            '--with-foo=%s\n' % (j, j))
+                f.write('install-commands:\n'
+                        '- make DESTDIR="$DESTDIR" install\n')
+
+
+def find_definitions(directory):
+    paths = []
+    for dirname, subdirs, filenames in os.walk(directory):
+        if '.git' in subdirs:
+            subdirs.remove('.git')
+        paths += [os.path.join(dirname, f) for f in filenames
+                  if f.endswith(('.morph', '.def'))]
+    # mix strata and chunks evenly through the batches
+    random.Random(0).shuffle(paths)
+    return paths
+
+
+def serial(paths):
+    start = time.time()
+    for path in paths:
+        definitions._parse_to_pickle(path)
+    return time.time() - start
+
+
+def parallel(paths, processes=None):
+    start = time.time()
+    pool = Pool(processes)
+    try:
+        pool.map(definitions._parse_to_pickle, paths, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return time.time() - start
+
+
+def best(function, *args):
+    # best of five, to keep the noise down
+    return min(function(*args) for i in range(5))
+
+
+def estimate(paths):
+    '''Return how many files it takes for a Pool to pay for itself.
+
+    That is the most for any of 2, 4 or 8 cpus, from the time to parse a
+    file, what the Pool adds to that for sending the result back, and how
+    long the Pool takes to start.
+
+    '''
+    parse = best(serial, paths) / len(paths)
+    pool_one = best(parallel, paths, 1) / len(paths) - parse
+    print('parse %.3fms/file, pool adds %.3fms/file' %
+          (parse * 1000, pool_one * 1000))
+    threshold = 0
+    for cpus in [2, 4, 8]:
+        startup = best(parallel, paths[:1], cpus)
+        saved = parse * (1 - 1.0 / cpus) - pool_one
+        crossover = int(startup / saved) + 1 if saved > 0 else None
+        print('  %s cpus: pool starts in %.1fms, and pays for itself '
+              'from %s files' % (cpus, startup * 1000, crossover))
+        threshold = max(threshold, crossover or 0)
+    return threshold
+
+
+def main():
+    tmpdir = None
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    else:
+        tmpdir = directory = tempfile.mkdtemp()
+        make_definitions(directory)
+    try:
+        paths = find_definitions(directory)
+        print('%s files, %s cpus, %s' % (len(paths), cpu_count(),
+                                         definitions.SafeLoader.__name__))
+
+        # the estimate is noisy, so take the median of several
+        thresholds = sorted(estimate(paths) for i in range(ROUNDS))
+        if cpu_count() > 1:
+            for count in [n for n in BATCHES if n < len(paths)]:
+                print('%6s files: serial %7.3fs  pool %7.3fs' %
+                      (count, best(serial, paths[:count]),
+                       best(parallel, paths[:count])))
+        print('pool pays for itself from %s-%s files, median %s; '
+              '_parallel_parse_min is %s' %
+              (thresholds[0], thresholds[-1], thresholds[len(thresholds) // 2],
+               definitions._parallel_parse_min))
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
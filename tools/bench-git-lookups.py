@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Compare git lookups by subprocess with repos.cat_file().
+
+Usage: bench-git-lookups.py [MIRRORS]
+
+Builds a scratch repo with some tagged commits, then times ref and tree
+lookups and get_version() both ways. Then it looks a ref up in MIRRORS
+(default 600) scratch mirrors, to check that the number of cat-files we
+keep running stays bounded.
+
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+import repos
+
+CALLS = 200
+
+
+def git(gitdir, *args):
+    return subprocess.check_output(('git',) + args, cwd=gitdir,
+                                   universal_newlines=True).strip()
+
+
+def quiet_call(gitdir, *args):
+    with open(os.devnull, 'w') as fnull:
+        return subprocess.call(('git',) + args, cwd=gitdir, stdout=fnull,
+                               stderr=fnull)
+
+
+def old_version(gitdir, ref):
+    # what get_version() did before it used a single describe --long
+    try:
+        described = git(gitdir, 'describe', '--tags', ref)
+        last_tag = git(gitdir, 'describe', '--abbrev=0', '--tags', ref)
+        commits = git(gitdir, 'rev-list', last_tag + '..' + ref, '--count')
+        return "%s %s (%s + %s commits)" % (ref[:8], described, last_tag,
+                                            commits)
+    except subprocess.CalledProcessError:
+        return ref[:8] + " (No tag found)"
+
+
+def timed(label, function, refs):
+    start = time.time()
+    for i in range(CALLS):
+        function(refs[i % len(refs)])
+    print('%-24s %8.3f ms/call' % (label,
+                                   (time.time() - start) * 1000 / CALLS))
+
+
+def make_repo(tmpdir):
+    gitdir = os.path.join(tmpdir, 'repo')
+    os.makedirs(gitdir)
+    git(gitdir, 'init', '-q')
+    for i in range(20):
+        with open(os.path.join(gitdir, 'file'), 'w') as f:
+            f.write('%s\n' % i)
+        git(gitdir, 'add', 'file')
+        git(gitdir, '-c', 'user.name=ybd', '-c', 'user.email=ybd@localhost',
+            'commit', '-q', '-m', str(i))
+        if i % 5 == 0:
+            git(gitdir, 'tag', 'v%s' % i)
+    return gitdir
+
+
+def main():
+    mirrors = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    app.settings['pid'] = os.getpid()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        gitdir = make_repo(tmpdir)
+        refs = git(gitdir, 'rev-list', '--all').split()
+
+        timed('has-ref subprocess',
+              lambda r: quiet_call(gitdir, 'cat-file', '-t', r) == 0, refs)
+        timed('has-ref cat_file',
+              lambda r: repos.mirror_has_ref(gitdir, r), refs)
+        timed('tree subprocess',
+              lambda r: git(gitdir, 'rev-parse', r + '^{tree}'), refs)
+        timed('tree cat_file',
+              lambda r: repos.cat_file(gitdir, r + '^{tree}'), refs)
+        timed('version 3 subprocesses', lambda r: old_version(gitdir, r),
+              refs)
+        timed('version describe', lambda r: repos.get_version(gitdir, r),
+              refs)
+
+        for ref in refs:
+            tree = git(gitdir, 'rev-parse', ref + '^{tree}')
+            assert repos.cat_file(gitdir, ref + '^{tree}')[0] == tree
+            assert repos.get_version(gitdir, ref) == old_version(gitdir, ref)
+        assert repos.cat_file(gitdir, '0' * 40) is None
+
+        bare = os.path.join(tmpdir, 'mirrors')
+        os.makedirs(bare)
+        start = time.time()
+        for i in range(mirrors):
+            mirror = os.path.join(bare, str(i))
+            git(tmpdir, 'clone', '-q', '--bare', '--shared', gitdir, mirror)
+            assert repos.mirror_has_ref(mirror, refs[0])
+            assert len(repos._cat_files) <= repos._cat_files_max
+        print('%-24s %8.3f ms/mirror, %s cat-files left running' %
+              ('%s mirrors' % mirrors, (time.time() - start) * 1000 / mirrors,
+               len(repos._cat_files)))
+        repos.close_cat_files()
+        assert not repos._cat_files
+    finally:
+        repos.close_cat_files()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,17 +28,35 @@ from assembly import assemble, deploy
 from definitions import Definitions
 import cache
 import platform
+import repos
 import sandbox
+import scheduler
 
 
 print('')
-if len(sys.argv) not in [2,3]:
-    sys.stderr.write("Usage: %s DEFINITION_FILE [ARCH]\n\n" % sys.argv[0])
+if sys.argv[1:] == ['--gc']:
+    app.load_settings()
+    cache.cull_unpacked(report=True)
+    cache.cull_sources(report=True)
+    cache.cull_objects(report=True)
+    sys.exit(0)
+
+args = sys.argv[1:]
+impact = None
+if args[:1] == ['--impact'] and len(args) in [3, 4]:
+    impact = args[2:]
+    args = args[1:2]
+
+if len(args) not in [1, 2]:
+    sys.stderr.write("Usage: %s DEFINITION_FILE [ARCH]\n" % sys.argv[0])
+    sys.stderr.write("       %s --impact DEFINITION_FILE COMPONENT [REF]\n"
+                     % sys.argv[0])
+    sys.stderr.write("       %s --gc\n\n" % sys.argv[0])
     sys.exit(1)
 
-target = sys.argv[1]
-if len(sys.argv) == 3:
-    arch = sys.argv[2]
+target = args[0]
+if len(args) == 2:
+    arch = args[1]
 else:
     arch = platform.machine()
     if arch in ('mips', 'mips64'):
@@ -56,12 +74,22 @@ with app.setup(target, arch):
                                                       target), arch)
         with app.timer('DEFINITIONS', 'Parsing %s' % app.settings['def-ver']):
             defs = Definitions()
+        if impact:
+            scheduler.impact(defs, app.settings['target'], *impact)
+            sys.exit(0)
         with app.timer('CACHE-KEYS', 'Calculating'):
+            cache.resolve_trees(defs, app.settings['target'])
             cache.get_cache(defs, app.settings['target'])
-        defs.save_trees()
+        if app.settings.get('prefetch-threads'):
+            graph = scheduler.build_graph(defs, app.settings['target'])
+            repos.prefetch([defs.get(path) for path in sorted(graph)])
 
         sandbox.executor = sandboxlib.executor_for_platform()
         app.log(target, 'Using %s for sandboxing' % sandbox.executor)
 
-        assemble(defs, app.settings['target'])
+        if app.settings.get('build-workers', 1) > 1:
+            scheduler.assemble(defs, app.settings['target'])
+        else:
+            assemble(defs, app.settings['target'])
         deploy(defs, app.settings['target'])
+        repos.wait_for_prefetch()